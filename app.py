@@ -2,13 +2,31 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from flask import Flask, request, jsonify, g
-import os, logging, sqlite3, json, requests, uuid
+import os, re, time, hmac, logging, sqlite3, json, requests, uuid
 from datetime import datetime
 
+BOOT_STARTED = time.time()
+
 import os
 import dropbox
 from flask_cors import CORS
-from database_backup import download_db, upload_db  # ✅ Dropbox sync helpers
+from database_backup import restore_task, mark_db_dirty, sync_worker  # ✅ Dropbox sync helpers
+import pawapay_client  # ✅ pooled PawaPay HTTP client (timeouts, retries, latency metrics)
+from callback_queue import CallbackQueue  # ✅ durable queue for acknowledge-first callbacks
+from group_commit import GroupCommitWriter  # ✅ batches callback writes into shared commits
+from callback_registry import ProcessedCallbackRegistry  # ✅ duplicate-callback fast path
+import storage  # ✅ the only place SQLite connections are opened (WAL, pragmas, per-thread reuse)
+import migrations  # ✅ versioned schema (PRAGMA user_version) for both databases
+from migrations import ESTACK_COLUMNS, ESTACK_POOL_PREDICATE, TRANSACTIONS_POOL_PREDICATE
+import export  # ✅ streaming NDJSON/CSV table exports
+from status_cache import status_cache, PENDING_STATUSES  # ✅ write-through cache for deposit status polling
+from deposit_events import deposit_events, TooManyWaiters  # ✅ long-poll/SSE waiters fed by callbacks
+from notifications import Notifier, unread_count  # ✅ queued, batched investor notifications with pluggable delivery
+import wallet_ledger  # ✅ append-only wallet entries; balances updated atomically
+from investment_pool import InvestmentPool, STRATEGIES, FIFO  # ✅ indexed available-investment matching with CAS claims
+import state_machine  # ✅ central loan/investment status transitions, applied with compare-and-set
+from state_machine import loan_states, investment_states, estack_loan_states, transactions_investment_states
+from pagination import PageError, page_args, field_list, table_columns, select_list, project, split_page, page_response  # ✅ keyset pages + ?fields=
 
 app = Flask(__name__)
 CORS(app)
@@ -17,42 +35,56 @@ CORS(app)
 #  🔹 Dropbox Auto Sync Section
 # ============================================================
 
-# Download the latest database on server startup
-print("⏬ Checking Dropbox for latest estack.db...")
-download_db()
+# The latest database is restored from Dropbox in the background on startup
+# (see restore_task.start below); write endpoints answer 503 until it is ready.
 
 def get_db():
-    """Connect to SQLite database"""
-    db = sqlite3.connect("estack.db", check_same_thread=False)
-    db.row_factory = sqlite3.Row
-    return db
+    """This thread's connection to estack.db (eStack investments and loans)."""
+    return storage.estack_db()
+
+
+def get_db_sc():
+    """This thread's connection to transactions.db (payments, loans, wallets, notifications)."""
+    return storage.transactions_db()
+
+
+# GET endpoints read through the read-only pools so polling never contends with writers
+def get_db_ro():
+    """Read-only estack.db connection for this request."""
+    return storage.estack_reader()
+
+
+def get_db_sc_ro():
+    """Read-only transactions.db connection for this request."""
+    return storage.transactions_reader()
 
 # -------------------------
 # API CONFIGURATION
 # -------------------------
-API_MODE = os.getenv("API_MODE", "sandbox")
-SANDBOX_API_TOKEN = os.getenv("SANDBOX_API_TOKEN")
-LIVE_API_TOKEN = os.getenv("LIVE_API_TOKEN")
+# PawaPay URLs/tokens live in pawapay_client; all PawaPay calls go through it.
+API_MODE = pawapay_client.API_MODE
 
-DATABASE_sc = os.path.join(os.path.dirname(__file__), "transactions.db")
+DATABASE_sc = storage.TRANSACTIONS_DB
 
-API_TOKEN = LIVE_API_TOKEN if API_MODE == "live" else SANDBOX_API_TOKEN
-PAWAPAY_URL = (
-    "https://api.pawapay.io/deposits"
-    if API_MODE == "live"
-    else "https://api.sandbox.pawapay.io/deposits"
-)
+# "sync": /callback/deposit applies callbacks before replying (default)
+# "queue": it only validates and durably enqueues them; workers apply asynchronously
+CALLBACK_INGEST_MODE = os.getenv("CALLBACK_INGEST_MODE", "sync")
+callback_queue = CallbackQueue() if CALLBACK_INGEST_MODE == "queue" else None
 
-PAWAPAY_PAYOUT_URL = (
-    "https://api.pawapay.io/v2/payouts"
-    if API_MODE == "live"
-    else "https://api.sandbox.pawapay.io/v2/payouts"
-)
+# Callback writes to each database go through one group-commit writer
+estack_writer = GroupCommitWriter(storage.ESTACK_DB)
+transactions_writer = GroupCommitWriter(DATABASE_sc)
+
+# (depositId|payoutId, status) pairs already applied; exact re-deliveries skip all DB work
+processed_callbacks = ProcessedCallbackRegistry(DATABASE_sc, writer=transactions_writer)
+
+# Investor notifications are queued and stored/delivered in batches off the request path
+notifier = Notifier(transactions_writer)
+
+# Investments that can still be lent out, matched to loans without scanning
+estack_pool = InvestmentPool(storage.ESTACK_DB, "estack_transactions", "deposit_id", ESTACK_POOL_PREDICATE)
+transactions_pool = InvestmentPool(DATABASE_sc, "transactions", "reference", TRANSACTIONS_POOL_PREDICATE)
 
-# -------------------------
-# DATABASE
-# -------------------------
-DATABASE = os.path.join(os.path.dirname(__file__), "transactions.db")
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -61,199 +93,121 @@ logger = logging.getLogger(__name__)
 def notify_investor(user_id, message):
     """
     Notify investor of investment status change.
-    In real systems this could send email, SMS, or push.
-    For now, we just log and store in a notifications table.
+    Only queues the notification: the notifier stores it in the notifications
+    table and delivers it (log, SMS, push - see NOTIFY_CHANNELS) in the background.
+    Call it after the change it reports has been committed.
     """
     try:
-        conn = sqlite3.connect(DATABASE)
-        cur = conn.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS notifications (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT,
-                message TEXT,
-                created_at TEXT
-            )
-        """)
-        conn.commit()
-
-        cur.execute("""
-            INSERT INTO notifications (user_id, message, created_at)
-            VALUES (?, ?, ?)
-        """, (user_id, message, datetime.utcnow().isoformat()))
-        conn.commit()
-        conn.close()
-
-        logger.info(f"📢 Notification sent to investor {user_id}: {message}")
+        notifier.notify(user_id, message)
     except Exception as e:
         logger.error(f"❌ Failed to notify investor {user_id}: {e}")
 
-def init_db_sc():
+def extract_metadata(metadata):
     """
-    Create the transactions and loans tables if missing and safely add any missing columns.
-    Also run a small backfill to populate 'type' and 'user_id' from metadata where possible.
+    The metadata fields we keep as indexed transactions columns. PawaPay sends
+    metadata either as a dict or as a [{"fieldName", "fieldValue"}] list, and it
+    is stored as JSON text; all three forms are accepted (field names are
+    case-insensitive). Returns {"user_id", "loan_id", "purpose"}, None if absent.
     """
-    conn = sqlite3.connect(DATABASE_sc)
-    cur = conn.cursor()
+    if isinstance(metadata, str):
+        try:
+            metadata = json.loads(metadata)
+        except ValueError:
+            metadata = None
+    if isinstance(metadata, list):
+        metadata = {
+            entry.get("fieldName"): entry.get("fieldValue")
+            for entry in metadata if isinstance(entry, dict)
+        }
+    if not isinstance(metadata, dict):
+        metadata = {}
+    fields = {str(k).lower(): v for k, v in metadata.items()}
+
+    def text(key):
+        value = fields.get(key)
+        return str(value) if value not in (None, "") else None
+
+    purpose = text("purpose")
+    return {
+        "user_id": text("userid"),
+        "loan_id": text("loanid"),
+        "purpose": purpose.lower() if purpose else None,
+    }
 
-    # Create wallets table if not exists
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS wallets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            balance REAL DEFAULT 0,
-            currency TEXT DEFAULT 'ZMW',
-            updated_at TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    # =========================
-    # ✅ TRANSACTIONS TABLE
-    # =========================
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            depositId TEXT UNIQUE,
-            status TEXT,
-            amount REAL,
-            currency TEXT,
-            phoneNumber TEXT,
-            provider TEXT,
-            providerTransactionId TEXT,
-            failureCode TEXT,
-            failureMessage TEXT,
-            metadata TEXT,
-            received_at TEXT,
-            updated_at TEXT,
-            created_at TEXT,
-            type TEXT DEFAULT 'payment',
-            user_id TEXT,
-            investment_id TEXT,
-            reference TEXT  -- ✅ added
-        )
-    """)
-    conn.commit()
 
-    cur.execute("PRAGMA table_info(transactions)")
-    existing_cols = [r[1] for r in cur.fetchall()]
-
-    needed = {
-        "reference": "TEXT",
-        "phoneNumber": "TEXT",
-        "metadata": "TEXT",
-        "updated_at": "TEXT",
-        "created_at": "TEXT",
-        "type": "TEXT DEFAULT 'payment'",
-        "user_id": "TEXT",
-        "investment_id": "TEXT"
-    }
+# Bump the version when the backfill logic changes so it re-runs over the whole table
+METADATA_BACKFILL = "transactions_metadata_v1"
+BACKFILL_BATCH = int(os.getenv("BACKFILL_BATCH", "1000"))
+SKIP_BACKFILL = os.getenv("SKIP_BACKFILL", "0") == "1"
 
-    for col, coltype in needed.items():
-        if col not in existing_cols:
-            try:
-                cur.execute(f"ALTER TABLE transactions ADD COLUMN {col} {coltype}")
-                logger.info("Added column %s to transactions table", col)
-            except sqlite3.OperationalError:
-                logger.warning("Could not add column %s (may already exist)", col)
-    conn.commit()
 
-        # =========================
-    # ✅ LOANS TABLE (matches code)
-    # =========================
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS loans (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            loanId TEXT UNIQUE,
-            user_id TEXT,
-            investment_id TEXT,
-            amount REAL,
-            interest REAL,
-            status TEXT,
-            expected_return_date TEXT,
-            created_at TEXT,
-            phone TEXT,
-            metadata TEXT
+def backfill_transactions_metadata(conn):
+    """
+    Fill user_id/type/loan_id/purpose from metadata for transactions rows added
+    since the last run. Progress is kept as a rowid high-water mark in
+    backfill_state and committed per batch, so a restart resumes where it left
+    off and a completed backfill costs one indexed lookup at startup.
+    """
+    row = conn.execute("SELECT last_rowid FROM backfill_state WHERE name = ?", (METADATA_BACKFILL,)).fetchone()
+    watermark = row[0] if row else 0
+    max_rowid = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM transactions").fetchone()[0]
+    if SKIP_BACKFILL or watermark >= max_rowid:
+        return
+
+    started = time.perf_counter()
+    scanned = updated = 0
+    while True:
+        rows = conn.execute("""
+            SELECT rowid, metadata, type, user_id, loan_id, purpose FROM transactions
+            WHERE rowid > ? ORDER BY rowid LIMIT ?
+        """, (watermark, BACKFILL_BATCH)).fetchall()
+        if not rows:
+            break
+
+        updates = []
+        for rowid, metadata, cur_type, cur_user, cur_loan, cur_purpose in rows:
+            meta = extract_metadata(metadata)
+            new_user = cur_user or meta["user_id"]
+            new_loan = cur_loan or meta["loan_id"]
+            new_purpose = cur_purpose or meta["purpose"]
+            new_type = "investment" if meta["purpose"] == "investment" else (cur_type or "payment")
+
+            if (new_user, new_type, new_loan, new_purpose) != (cur_user, cur_type, cur_loan, cur_purpose):
+                updates.append((new_user, new_type, new_loan, new_purpose, rowid))
+
+        watermark = rows[-1][0]
+        conn.executemany(
+            "UPDATE transactions SET user_id = ?, type = ?, loan_id = ?, purpose = ? WHERE rowid = ?",
+            updates
         )
-    """)
-    conn.commit()
+        conn.execute("""
+            INSERT INTO backfill_state (name, last_rowid, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET last_rowid = excluded.last_rowid, updated_at = excluded.updated_at
+        """, (METADATA_BACKFILL, watermark, datetime.utcnow().isoformat()))
+        conn.commit()
+        scanned += len(rows)
+        updated += len(updates)
 
-    cur.execute("PRAGMA table_info(loans)")
-    existing_loan_cols = [r[1] for r in cur.fetchall()]
-
-    loan_needed = {
-        "loanId": "TEXT UNIQUE",
-        "user_id": "TEXT",
-        "investment_id": "TEXT",
-        "amount": "REAL",
-        "interest": "REAL",
-        "status": "TEXT",
-        "expected_return_date": "TEXT",
-        "created_at": "TEXT",
-        "phone": "TEXT",
-        "metadata": "TEXT"
-    }
+    logger.info(
+        "Backfilled %d of %d transactions with user_id/type/loan_id/purpose from metadata in %.2fs (watermark %d).",
+        updated, scanned, time.perf_counter() - started, watermark
+    )
 
-    for col, coltype in loan_needed.items():
-        if col not in existing_loan_cols:
-            try:
-                cur.execute(f"ALTER TABLE loans ADD COLUMN {col} {coltype}")
-                logger.info("Added column %s to loans table", col)
-            except sqlite3.OperationalError:
-                logger.warning("Could not add column %s (may already exist)", col)
 
-    conn.commit()
+def init_db_sc():
+    """
+    Bring transactions.db to the current schema version (see migrations.py),
+    then backfill 'type', 'user_id', 'loan_id' and 'purpose' from metadata for
+    rows added since the last run.
+    """
+    conn = storage.connect(DATABASE_sc)
+    migrations.migrate_transactions(conn)
 
     # =========================
     # ✅ BACKFILL TRANSACTIONS
     # =========================
     try:
-        cur.execute("SELECT depositId, metadata, type, user_id FROM transactions")
-        rows = cur.fetchall()
-        updates = []
-        for deposit_id, metadata, cur_type, cur_user in rows:
-            new_type = cur_type
-            new_user = cur_user
-            changed = False
-            if metadata:
-                try:
-                    meta_obj = json.loads(metadata)
-                except Exception:
-                    meta_obj = None
-
-                if isinstance(meta_obj, list):
-                    for entry in meta_obj:
-                        if not isinstance(entry, dict):
-                            continue
-                        fn = str(entry.get("fieldName") or "").lower()
-                        fv = entry.get("fieldValue")
-                        if fn == "userid" and fv and not new_user:
-                            new_user = str(fv)
-                            changed = True
-                        if fn == "purpose" and isinstance(fv, str) and fv.lower() == "investment":
-                            if new_type != "investment":
-                                new_type = "investment"
-                                changed = True
-                elif isinstance(meta_obj, dict):
-                    if "userId" in meta_obj and not new_user:
-                        new_user = str(meta_obj.get("userId"))
-                        changed = True
-                    purpose = meta_obj.get("purpose")
-                    if isinstance(purpose, str) and purpose.lower() == "investment":
-                        if new_type != "investment":
-                            new_type = "investment"
-                            changed = True
-
-            if new_type is None:
-                new_type = "payment"
-
-            if changed or (cur_user is None and new_user is not None) or (cur_type is None and new_type):
-                updates.append((new_user, new_type, deposit_id))
-
-        for u, t, dep in updates:
-            cur.execute("UPDATE transactions SET user_id = ?, type = ? WHERE depositId = ?", (u, t, dep))
-        if updates:
-            conn.commit()
-            logger.info("Backfilled %d transactions with user_id/type from metadata.", len(updates))
+        backfill_transactions_metadata(conn)
     except Exception:
         logger.exception("Error during migration/backfill pass")
 
@@ -264,64 +218,6 @@ def init_db_sc():
 with app.app_context():
     init_db_sc()
 
-def get_db_sc():
-    """
-    Return a DB connection scoped to the Flask request context.
-    Row factory is sqlite3.Row for dict-like rows.
-    """
-    db = getattr(g, "_database", None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE_sc)
-        db.row_factory = sqlite3.Row
-    return db
-
-# -------------------------
-# LOANS TABLE INIT
-# -------------------------
-def init_loans_table():
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS loans (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        loanId TEXT UNIQUE,
-        user_id TEXT,
-        phone TEXT,                -- 🔹 NEW: borrower's phone number for payouts
-        investment_id TEXT,        -- 🔹 links this loan to an investment
-        amount REAL,
-        interest REAL,
-        status TEXT,               -- PENDING, APPROVED, DISAPPROVED, PAID
-        expected_return_date TEXT,
-        created_at TEXT,
-        approved_by TEXT
-    )
-    """)
-
-    conn.commit()
-    conn.close()
-    
-with app.app_context():
-    init_loans_table()
-
-def migrate_loans_table():
-    db = get_db_sc()
-    existing_columns = [col["name"] for col in db.execute("PRAGMA table_info(loans)").fetchall()]
-
-    # ✅ Ensure disbursed_at column exists
-    if "disbursed_at" not in existing_columns:
-        db.execute("ALTER TABLE loans ADD COLUMN disbursed_at TEXT")
-        db.commit()
-        print("✅ Added missing column: disbursed_at")
-
-    db.close()
-
-
-# ✅ run migrations safely once app starts
-with app.app_context():
-    init_db_sc()
-    migrate_loans_table()
-
-
 # -------------------------
 # REQUEST A LOAN
 # # -------------------------
@@ -332,13 +228,6 @@ from datetime import datetime
 
 app = Flask(__name__)
 
-DB_PATH = "estack.db"
-
-def get_db():
-    db = sqlite3.connect(DB_PATH)
-    db.row_factory = sqlite3.Row
-    return db
-
 
 # ------------------------
 # 1️⃣ REQUEST A LOAN
@@ -354,32 +243,41 @@ def request_loan():
         phone = data.get("phone")
         amount = data.get("amount")
         investment_id = data.get("investment_id")
+        # Only when asked for (and no investment_id given), the loan is matched
+        # to any available investment that covers it: "fifo" or "best_fit"
+        strategy = data.get("allocation")
 
         print(f"📨 Received investment_id: {investment_id}")
 
         # ✅ Validate required fields
-        if not phone or not investment_id or not amount:
+        if not phone or not amount or not (investment_id or strategy):
             return jsonify({"error": "Missing required fields"}), 400
+        if strategy is not None and strategy not in STRATEGIES:
+            return jsonify({"error": f"allocation must be one of {', '.join(STRATEGIES)}"}), 400
+
+        currency, loan_amount = split_amount(f"ZMW{amount}")
+        if loan_amount is None or loan_amount <= 0:
+            return jsonify({"error": "amount must be a positive number"}), 400
 
         db = get_db()
         cur = db.cursor()
 
-        # ✅ Find investment that includes this ID and is COMPLETED
-        cur.execute(
-            """
-            SELECT * FROM estack_transactions 
-            WHERE name_of_transaction LIKE ? 
-            AND status = 'COMPLETED'
-            """,
-            (f"%{investment_id}%",)
-        )
-        investment = cur.fetchone()
-
+        # ✅ Claim the investment (IN_USE) with a compare-and-set, so concurrent
+        # requests can never both get it
+        if investment_id:
+            # ✅ A named investment must be COMPLETED
+            investment = estack_pool.claim(db, "IN_USE", investment_id=investment_id, from_status="COMPLETED")
+        else:
+            investment = estack_pool.claim(db, "IN_USE", amount=loan_amount, strategy=strategy)
+        investment_states.record("IN_USE", 1 if investment else 0)
         if not investment:
-            db.close()
-            return jsonify({"error": "Investment not found or not completed"}), 404
+            db.rollback()
+            if investment_id:
+                return jsonify({"error": "Investment not found or not completed"}), 404
+            return jsonify({"error": "No available investment covers this amount"}), 404
+        investment_id = investment["investment_id"]
 
-        print(f"✅ Found matching investment: {investment['name_of_transaction']}")
+        print(f"✅ Claimed investment {investment_id}")
 
         # ✅ Generate unique loan ID and name
         loan_id = str(uuid.uuid4())
@@ -387,24 +285,25 @@ def request_loan():
 
         # ✅ Insert new loan record
         cur.execute(
-            "INSERT INTO estack_transactions (name_of_transaction, status) VALUES (?, ?)",
-            (loan_name, "ACTIVE")
-        )
-
-        # ✅ Mark investment as IN_USE
-        cur.execute(
-            "UPDATE estack_transactions SET status = ? WHERE name_of_transaction LIKE ?",
-            ("IN_USE", f"%{investment_id}%")
+            """
+            INSERT INTO estack_transactions
+            (name_of_transaction, status, deposit_id, user_id, kind, amount, currency,
+             borrower_phone, investment_id)
+            VALUES (?, ?, ?, ?, 'loan', ?, ?, ?, ?)
+            """,
+            (loan_name, "ACTIVE", loan_id, phone, loan_amount, currency, phone, investment_id)
         )
 
         db.commit()
-        db.close()
+        status_cache.invalidate("estack", investment_id)
+        mark_db_dirty()
 
         print(f"💰 Loan {loan_id} created for borrower {phone} using investment {investment_id}")
 
         return jsonify({
             "message": "Loan request recorded successfully",
             "loan_id": loan_id,
+            "investment_id": investment_id,
             "status": "ACTIVE"
         }), 200
 
@@ -557,20 +456,12 @@ def request_loan():
 @app.route("/api/loans/user/<user_id>", methods=["GET"])
 def get_user_loans(user_id):
     try:
-        db = get_db()
-        cur = db.cursor()
+        limit, after = page_args()
+        fields = field_list(("loan_id", "amount", "borrower", "status"))
+        db = get_db_ro()
 
         # Fetch transactions linked to this user (investor or borrower)
-        cur.execute(
-            """
-            SELECT * FROM estack_transactions
-            WHERE name_of_transaction LIKE ?
-            ORDER BY rowid DESC
-            """,
-            (f"%{user_id}%",)
-        )
-        rows = cur.fetchall()
-        db.close()
+        rows, next_cursor = estack_page_for_user(db, user_id, limit, after)
 
         results = []
         for r in rows:
@@ -593,10 +484,12 @@ def get_user_loans(user_id):
                 "borrower": borrower or "N/A",
                 "status": r["status"],
             }
-            results.append(entry)
+            results.append(project(entry, fields))
 
-        return jsonify(results), 200
+        return page_response(results, next_cursor)
 
+    except PageError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print("❌ Error fetching loans:", e)
         return jsonify({"error": str(e)}), 500
@@ -616,36 +509,41 @@ def create_loan_request():
         investment_id = data["investment_id"]
         amount = data["amount"]
 
+        _, loan_amount = split_amount(f"ZMW{amount}")
+        if loan_amount is None or loan_amount <= 0:
+            return jsonify({"error": "amount must be a positive number"}), 400
+
         conn = get_db()
         cur = conn.cursor()
 
-        # 🔍 1️⃣ Check if investment exists and is available
-        cur.execute(
-            "SELECT name_of_transaction, status FROM estack_transactions WHERE name_of_transaction LIKE ?",
-            (f"%{investment_id}%",)
-        )
-        investment = cur.fetchone()
-
-        if not investment:
-            conn.close()
-            return jsonify({"error": "Investment not found"}), 404
-
-        if investment["status"] != "AVAILABLE":
-            conn.close()
+        # 🔍 1️⃣ Claim the investment (REQUESTED) only if it is still AVAILABLE
+        claimed = estack_pool.claim(conn, "REQUESTED", investment_id=investment_id, from_status="AVAILABLE")
+        investment_states.record("REQUESTED", 1 if claimed else 0)
+        if not claimed:
+            conn.rollback()
+            exists = cur.execute(
+                "SELECT 1 FROM estack_transactions WHERE deposit_id = ?", (investment_id,)
+            ).fetchone()
+            if not exists:
+                return jsonify({"error": "Investment not found"}), 404
             return jsonify({"error": "Investment already loaned or pending"}), 400
 
         # 🧩 2️⃣ Update record to include borrower details
+        investment = cur.execute(
+            "SELECT name_of_transaction FROM estack_transactions WHERE id = ?", (claimed["id"],)
+        ).fetchone()
         old_name = investment["name_of_transaction"]
         # Example: "INVESTMENT | K1000 | user_12 | 0f59ea4f-bc6d"
         new_name = f"{old_name} | Borrower:{borrower_phone}"
 
         cur.execute(
-            "UPDATE estack_transactions SET name_of_transaction = ?, status = ? WHERE name_of_transaction = ?",
-            (new_name, "REQUESTED", old_name)
+            "UPDATE estack_transactions SET name_of_transaction = ?, borrower_phone = ? WHERE id = ?",
+            (new_name, borrower_phone, claimed["id"])
         )
 
         conn.commit()
-        conn.close()
+        status_cache.invalidate("estack", investment_id)
+        mark_db_dirty()
 
         print(f"✅ Loan requested: {new_name}")
 
@@ -672,39 +570,36 @@ def repay_loan(loan_id):
 
         # Find the loan transaction
         cur.execute(
-            "SELECT name_of_transaction FROM estack_transactions WHERE name_of_transaction LIKE ?",
-            (f"%{loan_id}%",)
+            "SELECT name_of_transaction, kind, deposit_id, borrower_phone, investment_id, status FROM estack_transactions WHERE deposit_id = ?",
+            (loan_id,)
         )
         loan = cur.fetchone()
 
         if not loan:
-            db.close()
             return jsonify({"error": "Loan not found"}), 404
 
-        # Mark the loan as REPAID
-        cur.execute(
-            "UPDATE estack_transactions SET status = ? WHERE name_of_transaction LIKE ?",
-            ("REPAID", f"%{loan_id}%")
-        )
+        # Mark the loan (or the loans drawn on this investment) as REPAID, if still ACTIVE
+        repaid = estack_loan_states.apply(cur, "REPAID", "deposit_id = ? OR investment_id = ?", (loan_id, loan_id))
+        if loan["kind"] == "investment":
+            repaid += investment_states.apply(cur, "REPAID", "deposit_id = ?", (loan_id,))
+        if not repaid:
+            db.rollback()
+            return jsonify({"error": f"Loan is {loan['status']}, nothing to repay"}), 409
 
-        # Extract user_id from transaction
-        parts = [p.strip() for p in loan["name_of_transaction"].split("|")]
-        user_id = parts[2] if len(parts) > 2 else None
+        # Loan rows are keyed to the borrower's phone, investments to their own depositId
+        user_id = loan["borrower_phone"] if loan["kind"] == "loan" else loan["deposit_id"]
 
-        # Make the user's investment AVAILABLE again
+        # Make the user's investment (and the one this loan drew on) AVAILABLE again
         if user_id:
-            cur.execute(
-                """
-                UPDATE estack_transactions
-                SET status = ?
-                WHERE name_of_transaction LIKE ?
-                AND name_of_transaction NOT LIKE ?
-                """,
-                ("AVAILABLE", f"%{user_id}%", "%LOAN%")
+            investment_states.apply(
+                cur, "AVAILABLE", "deposit_id IN (?, ?) OR user_id = ? OR borrower_phone = ?",
+                (user_id, loan["investment_id"], user_id, user_id)
             )
 
         db.commit()
-        db.close()
+        # Statuses of several rows (matched by phone/user) changed
+        status_cache.invalidate("estack")
+        mark_db_dirty()
 
         print(f"✅ Loan {loan_id} repaid — investment set to AVAILABLE")
 
@@ -791,10 +686,24 @@ def repay_loan(loan_id):
 # -------------------------
 @app.route("/api/loans/pending", methods=["GET"])
 def pending_loans():
-    db = get_db()
-    rows = db.execute("SELECT * FROM loans WHERE status='PENDING' ORDER BY created_at DESC").fetchall()
-    results = [dict(row) for row in rows]
-    return jsonify(results), 200
+    db = get_db_sc_ro()
+    try:
+        limit, after = page_args()
+        fields = field_list(table_columns(db, "loans"))
+    except PageError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Newest first by id (loans are inserted in request order); idx_loans_status
+    sql = f"SELECT {select_list(fields)} FROM loans WHERE status='PENDING'"
+    params = []
+    if after is not None:
+        sql += " AND id < ?"
+        params.append(after)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit + 1)
+    rows, next_cursor = split_page(db.execute(sql, params).fetchall(), limit)
+    results = [project(dict(row), fields) for row in rows]
+    return page_response(results, next_cursor)
 
 
 # -------------------------
@@ -803,48 +712,49 @@ def pending_loans():
 @app.route("/api/loans/approve/<loan_id>", methods=["POST"])
 def approve_loan(loan_id):
     try:
-        db = get_db()
+        db = get_db_sc()
         admin_id = request.json.get("admin_id", "admin_default")
 
-        # ✅ Fetch loan by loanId
-        loan = db.execute("SELECT * FROM loans WHERE loanId = ?", (loan_id,)).fetchone()
-        if not loan:
-            return jsonify({"error": "Loan not found"}), 404
-
-        # ✅ Prevent double approval
-        if loan["status"] and loan["status"].upper() == "APPROVED":
-            return jsonify({"message": "Loan already approved"}), 200
-
         now = datetime.utcnow().isoformat()
 
-        # ✅ Approve loan
-        db.execute("""
-            UPDATE loans
-            SET status = 'APPROVED',
-                approved_by = ?,
-                approved_at = ?,
-                updated_at = ?
-            WHERE loanId = ?
-        """, (admin_id, now, now, loan_id))
+        # ✅ Approve loan, only if it is still PENDING
+        if not loan_states.transition(db, loan_id, "APPROVED", approved_by=admin_id, approved_at=now, updated_at=now):
+            db.rollback()
+            current = loan_states.current(db, loan_id)
+            if current is None:
+                return jsonify({"error": "Loan not found"}), 404
+            # ✅ Prevent double approval
+            if current.upper() == "APPROVED":
+                return jsonify({"message": "Loan already approved"}), 200
+            return jsonify({"error": f"Loan is {current}, cannot be approved"}), 409
+
+        loan = db.execute("SELECT investment_id FROM loans WHERE loanId = ?", (loan_id,)).fetchone()
 
         # ✅ Update investor’s transaction using investment_id, not user_id
+        investor_id = None
         if loan["investment_id"]:
-            db.execute("""
-                UPDATE transactions
-                SET status = 'LOANED_OUT',
-                    updated_at = ?,
-                    failureMessage = 'Loan Approved',
-                    failureCode = 'LOAN'
-                WHERE depositId = ?
-            """, (now, loan["investment_id"]))
-            logger.info(f"✅ Investor transaction {loan['investment_id']} marked as LOANED_OUT.")
-
-            # ✅ Notify investor
-            txn = db.execute("SELECT user_id FROM transactions WHERE depositId=?", (loan["investment_id"],)).fetchone()
-            if txn and txn["user_id"]:
-                notify_investor(txn["user_id"], f"Your investment {loan['investment_id']} has been loaned out.")
+            # ✅ Only an ACTIVE investment can be loaned out
+            if transactions_investment_states.transition(
+                db, loan["investment_id"], "LOANED_OUT",
+                updated_at=now, failureMessage="Loan Approved", failureCode="LOAN",
+            ):
+                logger.info(f"✅ Investor transaction {loan['investment_id']} marked as LOANED_OUT.")
+                txn = db.execute("SELECT user_id FROM transactions WHERE depositId=?", (loan["investment_id"],)).fetchone()
+                investor_id = txn["user_id"] if txn else None
+            else:
+                # ✅ Never approve a loan whose investment cannot be loaned out
+                db.rollback()
+                current = transactions_investment_states.current(db, loan["investment_id"])
+                if current is None:
+                    return jsonify({"error": f"Investment {loan['investment_id']} not found"}), 409
+                return jsonify({"error": f"Investment {loan['investment_id']} is {current}, cannot be loaned out"}), 409
 
         db.commit()
+        if loan["investment_id"]:
+            status_cache.invalidate("transactions", loan["investment_id"])
+        # ✅ Notify investor once the approval is committed
+        if investor_id:
+            notify_investor(investor_id, f"Your investment {loan['investment_id']} has been loaned out.")
         return jsonify({"message": f"Loan {loan_id} approved and linked investor updated"}), 200
 
     except Exception as e:
@@ -906,8 +816,13 @@ def approve_loan(loan_id):
 # -------------------------
 @app.route("/api/loans/disapprove/<loan_id>", methods=["POST"])
 def disapprove_loan(loan_id):
-    db = get_db()
-    db.execute("UPDATE loans SET status='DISAPPROVED' WHERE loanId=?", (loan_id,))
+    db = get_db_sc()
+    if not loan_states.transition(db, loan_id, "DISAPPROVED", updated_at=datetime.utcnow().isoformat()):
+        db.rollback()
+        current = loan_states.current(db, loan_id)
+        if current is None:
+            return jsonify({"error": "Loan not found"}), 404
+        return jsonify({"error": f"Loan is {current}, cannot be disapproved"}), 409
     db.commit()
     return jsonify({"message": "Loan disapproved"}), 200
 
@@ -917,16 +832,14 @@ def disapprove_loan(loan_id):
 # -------------------------
 @app.route("/api/loans/user/<user_id>", methods=["GET"])
 def user_loans(user_id):
-    db = get_db()
+    db = get_db_sc_ro()
     rows = db.execute("SELECT * FROM loans WHERE user_id=? ORDER BY created_at DESC", (user_id,)).fetchall()
     results = [dict(row) for row in rows]
     return jsonify(results), 200
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, "_database", None)
-    if db is not None:
-        db.close()
+    storage.release(exception)
 
 
 # -------------------------
@@ -937,6 +850,40 @@ def home():
     return f"PawaPay Callback Receiver running ✅ (API_MODE={API_MODE})"
 
 
+# -------------------------
+# LIVENESS / READINESS
+# -------------------------
+# Served during the restore like GETs: read-only POSTs (batch lookups), and
+# mark_notifications_read, a write that only touches transactions.db, which
+# is migrated at import and does not depend on the estack.db restore
+READINESS_EXEMPT = {"home", "live", "ready", "static", "deposit_status_batch", "get_investment_status_batch",
+                    "mark_notifications_read"}
+
+
+@app.before_request
+def require_ready():
+    """Reject writes with 503 until estack.db has been restored and initialized."""
+    if request.method in ("GET", "HEAD", "OPTIONS") or request.endpoint in READINESS_EXEMPT:
+        return None
+    if request.endpoint == "deposit_callback" and callback_queue is not None:
+        return None  # queued callbacks are applied only after the restore completes
+    if not restore_task.ready:
+        return jsonify({"error": "Database restore in progress", **restore_task.status()}), 503, {"Retry-After": "5"}
+    return None
+
+
+@app.route("/live")
+def live():
+    return jsonify({"alive": True}), 200
+
+
+@app.route("/ready")
+def ready():
+    status = restore_task.status()
+    status["uptime_seconds"] = round(time.time() - BOOT_STARTED, 3)
+    return jsonify(status), 200 if status["ready"] else 503
+
+
 # # -------------------------
 # # ORIGINAL PAYMENT ENDPOINTS
 # # -------------------------
@@ -1019,8 +966,10 @@ def initiate_payment():
             ],
         }
 
-        headers = {"Authorization": f"Bearer {API_TOKEN}", "Content-Type": "application/json"}
-        resp = requests.post(PAWAPAY_URL, json=payload, headers=headers)
+        try:
+            resp = pawapay_client.initiate_deposit(payload)
+        except requests.RequestException:
+            return jsonify({"error": "PawaPay unavailable"}), 502
         result = {}
         try:
             result = resp.json()
@@ -1046,6 +995,7 @@ def initiate_payment():
             None
         ))
         db.commit()
+        status_cache.invalidate("transactions", deposit_id)
         logger.info("initiate-payment: inserted depositId=%s status=%s", deposit_id, result.get("status", "PENDING"))
         return jsonify({"depositId": deposit_id, **result}), 200
 
@@ -1194,114 +1144,112 @@ def initiate_payment():
 #         print("❌ Unified callback error:", e)
 #         return jsonify({"error": str(e)}), 500
 
-@app.route("/callback/deposit", methods=["POST"])
-def deposit_callback():
-    try:
-        data = request.get_json(force=True)
-        print("📩 Full callback data:", data)
+def classify_callback(data):
+    """Return "estack", "studycraft" or None for a PawaPay callback payload."""
+    if not isinstance(data, dict):
+        return None
+    metadata = data.get("metadata", {})
+    if isinstance(metadata, dict) and "userId" in metadata:
+        return "estack"
+    if "payer" in data or "recipient" in data:
+        return "studycraft"
+    return None
 
-        # Identify app type: StudyCraft vs eStack
-        metadata = data.get("metadata", {})
-        is_estack = isinstance(metadata, dict) and "userId" in metadata
-        is_studycraft = "payer" in data or "recipient" in data
-
-        # =====================================================
-        # 🔹 Case 1: eStack Application
-        # =====================================================
-        if is_estack:
-            deposit_id = data.get("depositId")
-            status = data.get("status", "PENDING").strip().upper()
-            amount = data.get("depositedAmount", 0)
-            user_id = metadata.get("userId", "unknown")
-
-            if not deposit_id:
-                return jsonify({"error": "Missing depositId"}), 400
-
-            name_of_transaction = f"ZMW{amount} | {user_id} | {deposit_id}"
-
-            db = sqlite3.connect("estack.db")
-            db.row_factory = sqlite3.Row
-            cur = db.cursor()
-
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS estack_transactions (
-                    name_of_transaction TEXT NOT NULL,
-                    status TEXT NOT NULL
-                )
-            """)
 
+def apply_callback(data):
+    """
+    Apply one PawaPay callback to the eStack or StudyCraft tables.
+    Returns (response body, HTTP status). Called by /callback/deposit directly
+    or, in queue ingestion mode, by the callback queue workers.
+    """
+    # Identify app type: StudyCraft vs eStack
+    metadata = data.get("metadata", {})
+    source = classify_callback(data)
+
+    # =====================================================
+    # 🔹 Case 1: eStack Application
+    # =====================================================
+    if source == "estack":
+        deposit_id = data.get("depositId")
+        status = data.get("status", "PENDING").strip().upper()
+        amount = data.get("depositedAmount", 0)
+        user_id = metadata.get("userId", "unknown")
+
+        if not deposit_id:
+            return {"error": "Missing depositId"}, 400
+
+        name_of_transaction = f"ZMW{amount} | {user_id} | {deposit_id}"
+
+        def write(cur):
             existing = cur.execute(
-                "SELECT name_of_transaction FROM estack_transactions WHERE name_of_transaction LIKE ?",
-                (f"%{deposit_id}%",)
+                "SELECT name_of_transaction FROM estack_transactions WHERE deposit_id = ?",
+                (deposit_id,)
             ).fetchone()
 
             if existing:
                 cur.execute(
-                    "UPDATE estack_transactions SET status = ? WHERE name_of_transaction LIKE ?",
-                    (status, f"%{deposit_id}%")
+                    "UPDATE estack_transactions SET status = ? WHERE deposit_id = ?",
+                    (status, deposit_id)
                 )
                 print(f"🔄 Updated eStack transaction {deposit_id} → {status}")
             else:
+                currency, amount_value = split_amount(f"ZMW{amount}")
                 cur.execute(
-                    "INSERT INTO estack_transactions (name_of_transaction, status) VALUES (?, ?)",
-                    (name_of_transaction, status)
+                    """
+                    INSERT INTO estack_transactions
+                    (name_of_transaction, status, deposit_id, user_id, kind, amount, currency)
+                    VALUES (?, ?, ?, ?, 'investment', ?, ?)
+                    """,
+                    (name_of_transaction, status, deposit_id, user_id, amount_value, currency)
                 )
                 print(f"💾 Inserted new eStack transaction {deposit_id} → {status}")
 
-            db.commit()
-            db.close()
+        # ✅ Committed in one transaction with any concurrent callbacks
+        estack_writer.run(write)
+        status_cache.put("estack", deposit_id, {"status": status})
+        deposit_events.publish(deposit_id, {"depositId": deposit_id, "status": status, "source": "eStack"})
+        processed_callbacks.record(deposit_id, status, "eStack")
 
-            # ✅ Dropbox Sync (optional if using persistence)
-            try:
-                from database_backup import upload_db
-                upload_db()
-            except Exception as sync_err:
-                print("⚠️ Dropbox sync skipped:", sync_err)
+        # ✅ Dropbox Sync: debounced upload in the background
+        mark_db_dirty()
 
-            return jsonify({"success": True, "source": "eStack", "deposit_id": deposit_id, "status": status}), 200
+        return {"success": True, "source": "eStack", "deposit_id": deposit_id, "status": status}, 200
 
-        # =====================================================
-        # 🔹 Case 2: StudyCraft Application
-        # =====================================================
-        elif is_studycraft:
-            deposit_id = data.get("depositId")
-            payout_id = data.get("payoutId")
+    # =====================================================
+    # 🔹 Case 2: StudyCraft Application
+    # =====================================================
+    elif source == "studycraft":
+        deposit_id = data.get("depositId")
+        payout_id = data.get("payoutId")
 
-            if not deposit_id and not payout_id:
-                return jsonify({"error": "Missing depositId/payoutId"}), 400
+        if not deposit_id and not payout_id:
+            return {"error": "Missing depositId/payoutId"}, 400
 
-            txn_type = "payment" if deposit_id else "payout"
-            txn_id = deposit_id or payout_id
-            status = data.get("status")
-            amount = data.get("amount")
-            currency = data.get("currency")
+        txn_type = "payment" if deposit_id else "payout"
+        txn_id = deposit_id or payout_id
+        status = data.get("status")
+        amount = data.get("amount")
+        currency = data.get("currency")
 
-            if txn_type == "payment":
-                phone = data.get("payer", {}).get("accountDetails", {}).get("phoneNumber")
-                provider = data.get("payer", {}).get("accountDetails", {}).get("provider")
-            else:
-                phone = data.get("recipient", {}).get("accountDetails", {}).get("phoneNumber")
-                provider = data.get("recipient", {}).get("accountDetails", {}).get("provider")
-
-            provider_txn = data.get("providerTransactionId")
-            failure_code = data.get("failureReason", {}).get("failureCode")
-            failure_message = data.get("failureReason", {}).get("failureMessage")
-
-            user_id, loan_id = None, None
-            metadata_obj = metadata
-            if metadata_obj:
-                if isinstance(metadata_obj, dict):
-                    user_id = metadata_obj.get("userId")
-                    loan_id = metadata_obj.get("loanId")
-                elif isinstance(metadata_obj, list):
-                    for entry in metadata_obj:
-                        if isinstance(entry, dict):
-                            if entry.get("fieldName") == "userId":
-                                user_id = entry.get("fieldValue")
-                            if entry.get("fieldName") == "loanId":
-                                loan_id = entry.get("fieldValue")
-
-            db = get_db_sc()
+        if txn_type == "payment":
+            phone = data.get("payer", {}).get("accountDetails", {}).get("phoneNumber")
+            provider = data.get("payer", {}).get("accountDetails", {}).get("provider")
+        else:
+            phone = data.get("recipient", {}).get("accountDetails", {}).get("phoneNumber")
+            provider = data.get("recipient", {}).get("accountDetails", {}).get("provider")
+
+        provider_txn = data.get("providerTransactionId")
+        failure_code = data.get("failureReason", {}).get("failureCode")
+        failure_message = data.get("failureReason", {}).get("failureMessage")
+
+        # Extracted once here into indexed columns, so reads never re-parse metadata
+        metadata_obj = metadata
+        meta = extract_metadata(metadata_obj)
+        user_id, loan_id, purpose = meta["user_id"], meta["loan_id"], meta["purpose"]
+        if purpose == "investment" and txn_type == "payment":
+            txn_type = "investment"
+
+        def write(db):
             existing = db.execute(
                 "SELECT * FROM transactions WHERE depositId=? OR depositId=?",
                 (deposit_id, payout_id)
@@ -1323,7 +1271,9 @@ def deposit_callback():
                         failureMessage = COALESCE(?, failureMessage),
                         metadata = COALESCE(?, metadata),
                         updated_at = ?,
-                        user_id = COALESCE(?, user_id)
+                        user_id = COALESCE(?, user_id),
+                        loan_id = COALESCE(?, loan_id),
+                        purpose = COALESCE(?, purpose)
                     WHERE depositId = ? OR depositId = ?
                 """, (
                     status,
@@ -1337,6 +1287,8 @@ def deposit_callback():
                     metadata_str,
                     now_iso,
                     user_id,
+                    loan_id,
+                    purpose,
                     deposit_id,
                     payout_id
                 ))
@@ -1344,8 +1296,9 @@ def deposit_callback():
                 db.execute("""
                     INSERT INTO transactions
                     (depositId, status, amount, currency, phoneNumber, provider, providerTransactionId,
-                     failureCode, failureMessage, metadata, received_at, updated_at, type, user_id)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                     failureCode, failureMessage, metadata, received_at, updated_at, type, user_id,
+                     loan_id, purpose)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """, (
                     txn_id,
                     status,
@@ -1360,32 +1313,144 @@ def deposit_callback():
                     now_iso,
                     now_iso,
                     txn_type,
-                    user_id
+                    user_id,
+                    loan_id,
+                    purpose
                 ))
 
-            # ✅ Handle loan repayment notification
+            # The row as /deposit_status serves it, for the status cache
+            row = db.execute("SELECT * FROM transactions WHERE depositId = ?", (txn_id,)).fetchone()
+            saved = transaction_dict(row) if row else None
+
+            # ✅ Handle loan repayment notification (once: only a disbursed loan becomes PAID)
             if txn_type == "payout" and loan_id and status in ("COMPLETED", "SUCCESS", "PAYMENT_COMPLETED"):
-                db.execute("UPDATE loans SET status=? WHERE loanId=?", (status, loan_id))
+                if not loan_states.transition(db, loan_id, "PAID", updated_at=now_iso):
+                    return None, saved
                 loan_row = db.execute("SELECT user_id FROM loans WHERE loanId=?", (loan_id,)).fetchone()
-                if loan_row and loan_row["user_id"]:
-                    notify_investor(
-                        loan_row["user_id"],
-                        f"Loan {loan_id[:8]} has been successfully repaid."
-                    )
+                return (loan_row["user_id"] if loan_row else None), saved
+            return None, saved
+
+        # ✅ Committed in one transaction with any concurrent callbacks;
+        # the investor is notified only after the commit
+        loan_owner, saved = transactions_writer.run(write)
+        if saved is not None:
+            status_cache.put("transactions", txn_id, saved)
+        deposit_events.publish(txn_id, {"depositId": txn_id, "status": status, "source": "StudyCraft"})
+        processed_callbacks.record(txn_id, status, "StudyCraft")
+        if loan_owner:
+            notify_investor(loan_owner, f"Loan {loan_id[:8]} has been successfully repaid.")
+
+        return {"received": True, "source": "StudyCraft"}, 200
+
+    # =====================================================
+    # 🔹 Unknown callback structure
+    # =====================================================
+    else:
+        return {"error": "Unknown callback format"}, 400
+
+
+def apply_queued_callback(data):
+    """Callback queue handler: True when applied, False if the payload can never apply."""
+    with app.app_context():
+        body, code = apply_callback(data)
+    if code >= 500:
+        raise RuntimeError(body.get("error", "callback apply failed"))
+    return code < 400
 
-            db.commit()
-            return jsonify({"received": True, "source": "StudyCraft"}), 200
 
-        # =====================================================
-        # 🔹 Unknown callback structure
-        # =====================================================
-        else:
-            return jsonify({"error": "Unknown callback format"}), 400
+@app.route("/callback/deposit", methods=["POST"])
+def deposit_callback():
+    try:
+        data = request.get_json(force=True)
+        print("📩 Full callback data:", data)
+
+        # ✅ Exact re-delivery of an applied callback: acknowledge without any DB work or sync
+        callback_id = data.get("depositId") or data.get("payoutId")
+        if callback_id and processed_callbacks.seen(callback_id, data.get("status")):
+            return jsonify({"received": True, "duplicate": True, "id": callback_id, "status": data.get("status")}), 200
+
+        if callback_queue is not None:
+            # ✅ Acknowledge first: validate, persist the raw payload, apply asynchronously
+            if classify_callback(data) is None:
+                return jsonify({"error": "Unknown callback format"}), 400
+            if not (data.get("depositId") or data.get("payoutId")):
+                return jsonify({"error": "Missing depositId/payoutId"}), 400
+            queue_id = callback_queue.enqueue(data)
+            return jsonify({"received": True, "queued": True, "queue_id": queue_id}), 200
+
+        body, code = apply_callback(data)
+        return jsonify(body), code
 
     except Exception as e:
         print("❌ Unified callback error:", e)
         return jsonify({"error": str(e)}), 500
 
+
+@app.route("/debug/callback-queue", methods=["GET"])
+def debug_callback_queue():
+    """Queue depth and apply lag for acknowledge-first callback ingestion."""
+    if callback_queue is None:
+        return jsonify({"mode": CALLBACK_INGEST_MODE}), 200
+    return jsonify({"mode": CALLBACK_INGEST_MODE, **callback_queue.stats()}), 200
+
+
+@app.route("/debug/callback-duplicates", methods=["GET"])
+def debug_callback_duplicates():
+    """Duplicate callback hit rate of the processed-callback registry."""
+    return jsonify(processed_callbacks.stats()), 200
+
+
+@app.route("/debug/group-commit", methods=["GET"])
+def debug_group_commit():
+    """Batch sizes of the callback group-commit writers."""
+    return jsonify({"estack": estack_writer.stats(), "transactions": transactions_writer.stats()}), 200
+
+
+@app.route("/debug/wallet-ledger", methods=["GET"])
+def debug_wallet_ledger():
+    """Recompute every wallet balance from the ledger and list the ones that disagree."""
+    return jsonify(wallet_ledger.verify(get_db_sc_ro())), 200
+
+
+# Admin-only debug actions require X-Admin-Token to match ADMIN_TOKEN; they are disabled while it is unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def is_admin():
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN)
+
+
+@app.route("/debug/wallet-ledger/rebuild", methods=["POST"])
+def debug_wallet_ledger_rebuild():
+    """Reset drifted wallet balances to their ledger sums; returns what was fixed. Admin only."""
+    if not is_admin():
+        return jsonify({"error": "Admin token required"}), 403
+    report = transactions_writer.run(wallet_ledger.rebuild)
+    return jsonify({"rebuilt": len(report["mismatches"]), **report}), 200
+
+
+@app.route("/debug/transitions", methods=["GET"])
+def debug_transitions():
+    """Allowed status transitions and how many were applied/rejected per target status."""
+    return jsonify(state_machine.stats()), 200
+
+
+@app.route("/debug/investment-pool", methods=["GET"])
+def debug_investment_pool():
+    """Size of the in-memory available-investment mirrors, claims and CAS conflicts."""
+    return jsonify({"estack": estack_pool.stats(), "transactions": transactions_pool.stats()}), 200
+
+
+@app.route("/debug/notifications", methods=["GET"])
+def debug_notifications():
+    """Queue depth, batch sizes and delivery failures of the notification pipeline."""
+    return jsonify(notifier.stats()), 200
+
+
+# ✅ Start queue workers once the databases are restored
+if callback_queue is not None:
+    callback_queue.start(apply_queued_callback, wait_for=restore_task.wait)
+
 # -------------------------
 # DEPOSIT STATUS / TRANSACTION LOOKUP
 # -------------------------
@@ -1556,10 +1621,62 @@ def deposit_callback():
 # -------------------------
 # OPTIONAL: debug route to see all transactions (helpful during testing)
 # -------------------------
+@app.route("/debug/sync", methods=["GET"])
+def debug_sync():
+    """Dropbox background sync state: last sync time and pending lag."""
+    return jsonify(sync_worker.status()), 200
+
+
+@app.route("/debug/deposit-events", methods=["GET"])
+def debug_deposit_events():
+    """Open long-poll/SSE waiters and events published to them."""
+    return jsonify(deposit_events.stats()), 200
+
+
+@app.route("/debug/status-cache", methods=["GET"])
+def debug_status_cache():
+    """Deposit status cache size, approximate footprint and hit ratio."""
+    return jsonify(status_cache.stats()), 200
+
+
+@app.route("/debug/read-pool", methods=["GET"])
+def debug_read_pool():
+    """Read-only connection pool usage and wait times per database."""
+    return jsonify(storage.read_pool_stats()), 200
+
+
+@app.route("/debug/pawapay", methods=["GET"])
+def debug_pawapay():
+    """Per-call PawaPay latency metrics for this worker."""
+    return jsonify(pawapay_client.metrics.snapshot()), 200
+
+
 @app.route("/debug/transactions", methods=["GET"])
 def debug_transactions():
-    db = get_db_sc()
-    rows = db.execute("SELECT * FROM transactions ORDER BY received_at DESC").fetchall()
+    db = get_db_sc_ro()
+    try:
+        limit, after = page_args()
+        fields = field_list(table_columns(db, "transactions"))
+    except PageError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Newest first by id: a keyset on received_at would skip rows whose callback
+    # updates received_at between pages
+    sql = f"SELECT {select_list(fields)} FROM transactions"
+    clauses, params = [], []
+    # ?user_id= / ?loan_id= / ?purpose= are index seeks on the extracted metadata columns
+    for column in ("user_id", "loan_id", "purpose", "type"):
+        if request.args.get(column):
+            clauses.append(f"{column} = ?")
+            params.append(request.args[column])
+    if after is not None:
+        clauses.append("id < ?")
+        params.append(after)
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit + 1)
+    rows, next_cursor = split_page(db.execute(sql, params).fetchall(), limit)
     results = []
     for row in rows:
         res = {k: row[k] for k in row.keys()}
@@ -1568,8 +1685,8 @@ def debug_transactions():
                 res["metadata"] = json.loads(res["metadata"])
             except:
                 pass
-        results.append(res)
-    return jsonify(results), 200
+        results.append(project(res, fields))
+    return page_response(results, next_cursor)
     
 #-----------------------------------
 # GET PENDING REQUESTS
@@ -1620,105 +1737,54 @@ def disburse_loan(loan_id):
         borrower_id = loan["user_id"]
         amount = float(loan["amount"])
 
-        # ✅ Fetch borrower wallet
-        borrower_wallet = db.execute(
-            "SELECT * FROM wallets WHERE user_id = ?", (borrower_id,)
-        ).fetchone()
-        
-        if not borrower_wallet:
-            db.execute("""
-                INSERT INTO wallets (user_id, balance, created_at, updated_at)
-                VALUES (?, 0, ?, ?)
-            """, (borrower_id, datetime.utcnow().isoformat(), datetime.utcnow().isoformat()))
-            db.commit()
-            logger.info(f"✅ Created new wallet for borrower {borrower_id}")
-        
-            borrower_wallet = db.execute(
-                "SELECT * FROM wallets WHERE user_id = ?", (borrower_id,)
-            ).fetchone()
-
-        borrower_balance = float(borrower_wallet["balance"])
-
-        # ✅ Credit borrower wallet
-        new_balance = borrower_balance + amount
-        db.execute(
-            "UPDATE wallets SET balance = ?, updated_at = ? WHERE user_id = ?",
-            (new_balance, datetime.utcnow().isoformat(), borrower_id)
-        )
-
-        # ✅ Mark loan as disbursed (fixed column name)
-        db.execute(
-            "UPDATE loans SET status = 'disbursed', disbursed_at = ? WHERE loanId = ?",
-            (datetime.utcnow().isoformat(), loan_id)
-        )
-
-        # ✅ Record the disbursement transaction
-        db.execute("""
-            INSERT INTO transactions (user_id, amount, type, status, reference, created_at, updated_at)
-            VALUES (?, ?, 'loan_disbursement', 'SUCCESS', ?, ?, ?)
-        """, (
-            borrower_id, amount, loan_id,
-            datetime.utcnow().isoformat(),
-            datetime.utcnow().isoformat()
-        ))
-
-        db.commit()
-
-        # ✅ Link this loan to one available investment
+        def disburse(conn):
+            now = datetime.utcnow().isoformat()
+            # ✅ Mark loan as disbursed, only if it is APPROVED (not yet disbursed by a concurrent request)
+            if not loan_states.transition(conn, loan_id, "disbursed", disbursed_at=now):
+                return None
+
+            # ✅ Credit borrower wallet (ledger entry + balance = balance + amount)
+            balance = wallet_ledger.post(conn, borrower_id, amount, "loan_disbursement", loan_id)
+
+            # ✅ Record the disbursement transaction
+            conn.execute("""
+                INSERT INTO transactions (user_id, amount, type, status, reference, created_at, updated_at)
+                VALUES (?, ?, 'loan_disbursement', 'SUCCESS', ?, ?, ?)
+            """, (borrower_id, amount, loan_id, now, now))
+            return balance
+
+        # ✅ Loan status, ledger entry, balance and transaction row commit together
+        new_balance = transactions_writer.run(disburse)
+        if new_balance is None:
+            current = loan_states.current(db, loan_id)
+            return jsonify({"error": f"Loan {loan_id} is {current}, cannot be disbursed"}), 409
+
+        # ✅ Link this loan to one available investment (oldest first)
         try:
-            # investment_row = db.execute("""
-            #     SELECT depositId FROM transactions
-            #     WHERE type = 'investment' AND status = 'ACTIVE'
-            #     ORDER BY received_at ASC LIMIT 1
-            # """).fetchone()
-            investment_row = db.execute("""
-                SELECT reference FROM transactions
-                WHERE type = 'investment' AND status = 'ACTIVE'
-                ORDER BY created_at ASC LIMIT 1
-            """).fetchone()
-
-
-            if investment_row:
-                # investment_id = investment_row["depositId"]
-                investment_id = investment_row["reference"]
+            # ✅ Mark that single investment as LOANED_OUT (compare-and-set claim)
+            investment = transactions_pool.claim(db, "LOANED_OUT", strategy=FIFO)
+            transactions_investment_states.record("LOANED_OUT", 1 if investment else 0)
+
+            if investment:
+                investment_id = investment["investment_id"] or ""
+                db.execute(
+                    "UPDATE transactions SET updated_at = ? WHERE id = ?",
+                    (datetime.utcnow().isoformat(), investment["id"])
+                )
 
+                investor_row = db.execute(
+                    "SELECT user_id FROM transactions WHERE id = ?", (investment["id"],)
+                ).fetchone()
 
-                # ✅ Mark that single investment as LOANED_OUT
-                db.execute("""
-                    UPDATE transactions
-                    SET status = 'LOANED_OUT', updated_at = ?
-                    WHERE reference = ?
+                # ✅ Also mark investor's transaction as DISBURSED (only from LOANED_OUT)
+                if loan["investment_id"] and transactions_investment_states.transition(
+                    db, loan["investment_id"], "DISBURSED", updated_at=datetime.utcnow().isoformat()
+                ):
+                    logger.info(f"✅ Investor transaction {loan['investment_id']} marked as DISBURSED.")
 
-                    # UPDATE transactions
-                    # SET status = 'LOANED_OUT', investment_id = ?, updated_at = ?
-                    # WHERE depositId = ?
-                """, (loan_id, datetime.utcnow().isoformat(), investment_id))
                 db.commit()
 
                 # ✅ Notify the investor
-                investor_row = db.execute("""
-                    SELECT user_id FROM transactions
-                    WHERE reference = ? AND type = 'investment'
-                    # SELECT user_id FROM transactions
-                    # WHERE depositId = ? AND type = 'investment'
-                """, (investment_id,)).fetchone()
-                # investment_row = db.execute("""
-                #     SELECT reference FROM transactions
-                #     WHERE type = 'investment' AND status = 'ACTIVE'
-                #     ORDER BY created_at ASC LIMIT 1
-                # """).fetchone()
-
-                # ✅ Also mark investor's transaction as DISBURSED
-                if loan["investment_id"]:
-                    db.execute("""
-                        UPDATE transactions
-                        SET status = 'DISBURSED', updated_at = ?
-                        WHERE depositId = ?
-                    """, (datetime.utcnow().isoformat(), loan["investment_id"]))
-                    logger.info(f"✅ Investor transaction {loan['investment_id']} marked as DISBURSED.")
-
-
-
                 if investor_row and investor_row["user_id"]:
                     notify_investor(
                         investor_row["user_id"],
@@ -1727,11 +1793,16 @@ def disburse_loan(loan_id):
 
                 logger.info(f"Investment {investment_id} linked to loan {loan_id}")
             else:
+                db.rollback()
                 logger.warning("No available active investment found to link with this loan.")
 
         except Exception as e:
+            db.rollback()
             logger.error(f"Error linking investment to loan {loan_id}: {e}")
 
+        # Investor rows were updated by reference as well as by depositId
+        status_cache.invalidate("transactions")
+
         return jsonify({
             "message": f"Loan {loan_id} successfully disbursed",
             "borrower_id": borrower_id,
@@ -1750,13 +1821,12 @@ def disburse_loan(loan_id):
 def reject_loan(loan_id):
     admin_id = request.json.get("admin_id", "admin_default")
     db = get_db_sc()
-    loan = db.execute("SELECT * FROM loans WHERE loanId=?", (loan_id,)).fetchone()
-    if not loan:
-        return jsonify({"error": "Loan not found"}), 404
-    if loan["status"] != "PENDING":
-        return jsonify({"error": f"Loan already {loan['status']}"}), 400
-
-    db.execute("UPDATE loans SET status='REJECTED', approved_by=? WHERE loanId=?", (admin_id, loan_id))
+    if not loan_states.transition(db, loan_id, "REJECTED", approved_by=admin_id):
+        db.rollback()
+        current = loan_states.current(db, loan_id)
+        if current is None:
+            return jsonify({"error": "Loan not found"}), 404
+        return jsonify({"error": f"Loan already {current}"}), 400
     db.commit()
 
     return jsonify({"loanId": loan_id, "status": "REJECTED"}), 200
@@ -1764,26 +1834,77 @@ def reject_loan(loan_id):
 # OPTIONAL CODE CHECK NOTIFICATION 
 @app.route("/api/notifications/<user_id>", methods=["GET"])
 def get_notifications(user_id):
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM notifications WHERE user_id=? ORDER BY created_at DESC", (user_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return jsonify([dict(row) for row in rows]), 200
+    """
+    Newest-first pages of a user's notifications, or with ?since=<id> only the
+    ones newer than id (oldest first) plus the unread count, so the app can
+    fetch the delta on every screen open instead of the whole list.
+    """
+    conn = get_db_sc_ro()
+    try:
+        limit, after = page_args()
+        fields = field_list(table_columns(conn, "notifications"))
+        since = request.args.get("since")
+        if since not in (None, ""):
+            if after is not None:
+                raise PageError("since and after cannot be combined")
+            try:
+                since = int(since)
+            except ValueError:
+                raise PageError("since must be a notification id")
+        else:
+            since = None
+    except PageError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if since is not None:
+        rows = conn.execute(
+            f"SELECT {select_list(fields)} FROM notifications WHERE user_id=? AND id > ? ORDER BY id LIMIT ?",
+            (user_id, since, limit + 1),
+        ).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        return jsonify({
+            "items": [project(dict(row), fields) for row in rows],
+            "since": rows[-1]["id"] if rows else since,     # pass back as ?since= next time
+            "more": more,
+            "unread": unread_count(conn, user_id),
+        }), 200
 
-# -------------------------
-# RUN
-# -------------------------
+    sql = f"SELECT {select_list(fields)} FROM notifications WHERE user_id=?"
+    params = [user_id]
+    if after is not None:
+        sql += " AND id < ?"
+        params.append(after)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit + 1)
+    rows, next_cursor = split_page(conn.execute(sql, params).fetchall(), limit)
+    return page_response([project(dict(row), fields) for row in rows], next_cursor)
 
-if __name__ == "__main__":
-    with app.app_context():
-        init_db()
-        init_db_sc()
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+
+@app.route("/api/notifications/<user_id>/unread", methods=["GET"])
+def get_unread_notifications(user_id):
+    """Badge count, kept up to date on every write."""
+    return jsonify({"user_id": user_id, "unread": unread_count(get_db_sc_ro(), user_id)}), 200
 
 
+@app.route("/api/notifications/<user_id>/read", methods=["POST"])
+def mark_notifications_read(user_id):
+    """Body {"ids": [...]} or {"up_to": id}; an empty body marks everything read."""
+    data = request.get_json(silent=True) or {}
+    ids, up_to = data.get("ids"), data.get("up_to")
+    try:
+        if ids is not None:
+            if not isinstance(ids, list):
+                raise ValueError
+            ids = [int(i) for i in ids]
+        if up_to is not None:
+            up_to = int(up_to)
+    except (TypeError, ValueError):
+        return jsonify({"error": "ids must be a list of notification ids and up_to a notification id"}), 400
+
+    marked, unread = notifier.mark_read(user_id, up_to=up_to, ids=ids)
+    return jsonify({"user_id": user_id, "marked": marked, "unread": unread}), 200
+
 # from dotenv import load_dotenv
 # load_dotenv()
 
@@ -1819,49 +1940,105 @@ if __name__ == "__main__":
 # logging.basicConfig(level=logging.INFO)
 # logger = logging.getLogger(__name__)
 
-# =========================
-# ✅ DATABASE CONFIG
-# =========================
-DATABASE = os.path.join(os.path.dirname(__file__), "estack.db")
+def split_amount(value):
+    """Split "ZMW100" / "K1000" into ("ZMW", 100.0). Returns (None, None) if unparseable."""
+    match = re.match(r"^\s*([A-Za-z]*)\s*([0-9]+(?:\.[0-9]+)?)\s*$", str(value or ""))
+    if not match:
+        return None, None
+    return match.group(1) or None, float(match.group(2))
+
+
+def parse_transaction_name(name):
+    """
+    Parse a pipe-delimited name_of_transaction into structured fields.
+      "ZMW100 | user_1 | dep_1"                      -> investment
+      "ZMW100 | user_1 | dep_1 | Borrower:097..."    -> investment with borrower
+      "LOAN | ZMW100 | 097... | dep_1 | loan_1"      -> loan
+    """
+    parts = [p.strip() for p in (name or "").split("|")]
+    fields = dict.fromkeys(ESTACK_COLUMNS)
+
+    if parts and parts[0].upper() == "LOAN":
+        fields["kind"] = "loan"
+        if len(parts) > 1:
+            fields["currency"], fields["amount"] = split_amount(parts[1])
+        if len(parts) > 2:
+            fields["user_id"] = fields["borrower_phone"] = parts[2] or None
+        if len(parts) > 3:
+            fields["investment_id"] = parts[3] or None
+        if len(parts) > 4:
+            fields["deposit_id"] = parts[4] or None
+        return fields
+
+    fields["kind"] = "investment"
+    fields["currency"], fields["amount"] = split_amount(parts[0] if parts else None)
+    if len(parts) > 1:
+        fields["user_id"] = parts[1] or None
+    if len(parts) > 2:
+        fields["deposit_id"] = parts[2] or None
+    for extra in parts[3:]:
+        if extra.startswith("Borrower:"):
+            fields["borrower_phone"] = extra.split(":", 1)[1].strip() or None
+    return fields
+
 
 def init_db():
     """
-    Create the estack_transactions table if missing.
-    Stores combined transaction info and status only.
+    Bring estack.db to the current schema version (see migrations.py).
+    estack_transactions stores combined transaction info and status, plus
+    structured/indexed columns parsed from name_of_transaction (backfilled
+    once for old rows).
     """
-    conn = sqlite3.connect(DATABASE)
+    conn = storage.connect(storage.ESTACK_DB)
+    migrations.migrate_estack(conn)
     cur = conn.cursor()
 
-    # ✅ Create the single table
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS estack_transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name_of_transaction TEXT NOT NULL,  -- e.g. "K1000 | user_123 | DEP4567"
-            status TEXT NOT NULL,               -- e.g. "invested", "loaned_out", "repaid"
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
+    # ✅ One-time backfill: rows written before the structured columns existed
+    rows = cur.execute(
+        "SELECT rowid, name_of_transaction FROM estack_transactions WHERE kind IS NULL"
+    ).fetchall()
+    if rows:
+        updates = []
+        for rowid, name in rows:
+            f = parse_transaction_name(name)
+            updates.append((
+                f["deposit_id"], f["user_id"], f["kind"], f["amount"],
+                f["currency"], f["borrower_phone"], f["investment_id"], rowid
+            ))
+        cur.executemany("""
+            UPDATE estack_transactions
+            SET deposit_id = ?, user_id = ?, kind = ?, amount = ?, currency = ?,
+                borrower_phone = ?, investment_id = ?
+            WHERE rowid = ?
+        """, updates)
+        logger.info("Backfilled %d estack_transactions rows from name_of_transaction.", len(updates))
 
     conn.commit()
     conn.close()
     print("✅ estack.db initialized with estack_transactions table.")
 
 
-# ✅ Initialize database once Flask app starts
-with app.app_context():
+def on_estack_restored():
+    """Runs in the restore thread once estack.db is in place."""
+    storage.invalidate(storage.ESTACK_DB)
     init_db()
+    logger.info("🚀 Ready in %.2fs (restore %.2fs)",
+                time.time() - BOOT_STARTED, restore_task.status()["elapsed_seconds"])
+
+
+# ✅ Restore from Dropbox and initialize database in the background
+restore_task.start(on_restored=on_estack_restored)
+
+# ✅ Long-poll/SSE waiters also hear about commits made by other worker processes
+deposit_events.start([
+    (DATABASE_sc, "SELECT depositId, status FROM transactions WHERE depositId IN ({})", "StudyCraft"),
+    (storage.ESTACK_DB, "SELECT deposit_id, status FROM estack_transactions WHERE deposit_id IN ({})", "eStack"),
+])
+
+# ✅ Trim old, read notifications in the background
+notifier.start_retention()
 
 
-def get_db():
-    """
-    Return a DB connection scoped to the Flask request context.
-    Row factory is sqlite3.Row for dict-like access.
-    """
-    db = getattr(g, "_database", None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
-    return db
     
 # # -------------------------
 # # REQUEST A LOAN
@@ -2160,32 +2337,177 @@ def get_db():
 #         return jsonify({"error": "not found"}), 404
 #     return jsonify(dict(row)), 200
 
-@app.route("/deposit_status/<deposit_id>")
-def deposit_status(deposit_id):
-    db = get_db_sc()
-    row = db.execute("SELECT * FROM transactions WHERE depositId=?", (deposit_id,)).fetchone()
-    if not row:
-        return jsonify({"status": None, "message": "Deposit not found"}), 404
+def transaction_dict(row):
+    """A transactions row as the status endpoints return it (metadata decoded)."""
     res = {k: row[k] for k in row.keys()}
     if res.get("metadata"):
         try:
             res["metadata"] = json.loads(res["metadata"])
         except:
             pass
+    return res
+
+
+def cached_transaction(deposit_id):
+    """The transaction for deposit_id from the status cache, else the database (then cached)."""
+    res = status_cache.get("transactions", deposit_id)
+    if res is None:
+        version = status_cache.version("transactions", deposit_id)
+        row = get_db_sc_ro().execute("SELECT * FROM transactions WHERE depositId=?", (deposit_id,)).fetchone()
+        if not row:
+            return None
+        res = transaction_dict(row)
+        status_cache.fill("transactions", deposit_id, res, version)
+    return res
+
+
+STATUS_BATCH_MAX = int(os.getenv("STATUS_BATCH_MAX", "200"))
+
+
+def batch_ids():
+    """The validated "ids" list from a batch status request body. Raises ValueError."""
+    data = request.get_json(silent=True)
+    ids = data.get("ids") if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not ids:
+        raise ValueError('Body must be {"ids": [...]} with at least one id')
+    if len(ids) > STATUS_BATCH_MAX:
+        raise ValueError(f"At most {STATUS_BATCH_MAX} ids per request")
+    if not all(isinstance(i, (str, int)) for i in ids):
+        raise ValueError("ids must be strings")
+    return list(dict.fromkeys(str(i) for i in ids))
+
+
+def batch_statuses(namespace, ids, db, sql):
+    """
+    {id: status} for ids, from the status cache where possible and one
+    indexed IN (...) query for the rest. Unknown ids map to None.
+    """
+    statuses, missing = {}, []
+    for deposit_id in ids:
+        cached = status_cache.get(namespace, deposit_id)
+        if cached is not None:
+            statuses[deposit_id] = cached["status"]
+        else:
+            missing.append(deposit_id)
+    if missing:
+        rows = db.execute(sql.format(",".join("?" * len(missing))), missing).fetchall()
+        for deposit_id, status in rows:
+            statuses[deposit_id] = status
+    return {deposit_id: statuses.get(deposit_id) for deposit_id in ids}
+
+
+@app.route("/deposit_status/batch", methods=["POST"])
+def deposit_status_batch():
+    """{"ids": [...]} -> {id: status}; one query for every id not in the status cache."""
+    try:
+        ids = batch_ids()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(batch_statuses(
+        "transactions", ids, get_db_sc_ro(),
+        "SELECT depositId, status FROM transactions WHERE depositId IN ({})",
+    )), 200
+
+
+LONGPOLL_MAX_WAIT = 60      # seconds
+SSE_HEARTBEAT = 15          # seconds between keep-alive comments
+SSE_MAX_DURATION = 300      # seconds before the server ends a stream (EventSource reconnects)
+
+
+def wait_seconds():
+    try:
+        return max(0.0, min(float(request.args.get("wait", 0)), LONGPOLL_MAX_WAIT))
+    except ValueError:
+        return 0.0
+
+
+@app.route("/deposit_status/<deposit_id>")
+def deposit_status(deposit_id):
+    """?wait=N (seconds, max 60) blocks an in-flight deposit until its status changes or N elapses."""
+    wait = wait_seconds()
+    sub = None
+    if wait:
+        try:
+            # Subscribe before reading, so a callback in between is not missed
+            sub = deposit_events.subscribe(deposit_id)
+        except TooManyWaiters:
+            wait = 0
+    try:
+        res = cached_transaction(deposit_id)
+        # Unknown and settled deposits answer at once; only in-flight ones wait
+        current = res["status"] if res else None
+        if wait and res is not None and str(current).upper() in PENDING_STATUSES:
+            storage.release()   # no DB connection is held while waiting
+            deadline = time.monotonic() + wait
+            while True:
+                event = sub.next(deadline - time.monotonic())
+                if event is None:
+                    break
+                if event["status"] != current:
+                    # The change may have been committed by another worker; read it fresh
+                    status_cache.invalidate("transactions", deposit_id)
+                    res = cached_transaction(deposit_id)
+                    break
+    finally:
+        if sub is not None:
+            sub.close()
+    if res is None:
+        return jsonify({"status": None, "message": "Deposit not found"}), 404
     return jsonify(res), 200
 
+
+@app.route("/events/deposits/<deposit_id>")
+def deposit_events_stream(deposit_id):
+    """Server-Sent Events: the current status, then every transition until it settles."""
+    try:
+        sub = deposit_events.subscribe(deposit_id)
+    except TooManyWaiters as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "5"}
+    try:
+        res = cached_transaction(deposit_id)
+        first = {"depositId": deposit_id, "status": res["status"] if res else None, "source": "StudyCraft"}
+        if res is None:
+            cached = status_cache.get("estack", deposit_id)
+            row = cached or get_db_ro().execute(
+                "SELECT status FROM estack_transactions WHERE deposit_id = ?", (deposit_id,)
+            ).fetchone()
+            if not row:
+                sub.close()
+                return jsonify({"error": "Deposit not found"}), 404
+            first = {"depositId": deposit_id, "status": row["status"], "source": "eStack"}
+        storage.release()
+    except Exception:
+        sub.close()
+        raise
+
+    def stream():
+        last = first["status"]
+        deadline = time.monotonic() + SSE_MAX_DURATION
+        try:
+            yield f"retry: 3000\nevent: status\ndata: {json.dumps(first)}\n\n"
+            while last is None or str(last).upper() in PENDING_STATUSES:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                event = sub.next(min(SSE_HEARTBEAT, remaining))
+                if event is None:
+                    yield ": keep-alive\n\n"
+                elif event["status"] != last:
+                    last = event["status"]
+                    yield f"event: status\ndata: {json.dumps(event)}\n\n"
+        finally:
+            sub.close()
+
+    return app.response_class(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
 @app.route("/transactions/<deposit_id>")
 def get_transaction(deposit_id):
-    db = get_db_sc()
-    row = db.execute("SELECT * FROM transactions WHERE depositId=?", (deposit_id,)).fetchone()
-    if not row:
+    res = cached_transaction(deposit_id)
+    if res is None:
         return jsonify({"error": "not found"}), 404
-    res = {k: row[k] for k in row.keys()}
-    if res.get("metadata"):
-        try:
-            res["metadata"] = json.loads(res["metadata"])
-        except:
-            pass
     return jsonify(res), 200
 
 # -------------------------
@@ -2223,8 +2545,10 @@ def initiate_investment():
             ],
         }
 
-        headers = {"Authorization": f"Bearer {API_TOKEN}", "Content-Type": "application/json"}
-        resp = requests.post(PAWAPAY_URL, json=payload, headers=headers)
+        try:
+            resp = pawapay_client.initiate_deposit(payload)
+        except requests.RequestException:
+            return jsonify({"error": "PawaPay unavailable"}), 502
 
         # Try decoding the response
         try:
@@ -2242,10 +2566,13 @@ def initiate_investment():
         # Save to estack.db
         db = get_db()
         db.execute("""
-            INSERT INTO estack_transactions (name_of_transaction, status)
-            VALUES (?, ?)
-        """, (name_of_transaction, status))
+            INSERT INTO estack_transactions
+            (name_of_transaction, status, deposit_id, user_id, kind, amount, currency)
+            VALUES (?, ?, ?, ?, 'investment', ?, ?)
+        """, (name_of_transaction, status, deposit_id, str(user_id), split_amount(amount)[1], currency))
         db.commit()
+        status_cache.invalidate("estack", deposit_id)
+        mark_db_dirty()
 
         logger.info("💰 Investment initiated: %s (user_id=%s, status=%s)",
                     name_of_transaction, user_id, status)
@@ -2262,20 +2589,42 @@ def initiate_investment():
         logger.exception("Investment initiation error")
         return jsonify({"error": str(e)}), 500
 
+def estack_page_for_user(db, user_id, limit, after=None):
+    """
+    One page (newest first) of estack_transactions where the user is the investor
+    or the borrower. Each OR branch is a range scan on idx_estack_user_id /
+    idx_estack_borrower_phone. Returns (rows, next_cursor).
+    """
+    sql = """
+        SELECT rowid AS row_key, name_of_transaction, status
+        FROM estack_transactions
+        WHERE (user_id = ? OR borrower_phone = ?)
+    """
+    params = [user_id, user_id]
+    if after is not None:
+        sql += " AND rowid < ?"
+        params.append(after)
+    sql += " ORDER BY rowid DESC LIMIT ?"
+    params.append(limit + 1)
+    return split_page(db.execute(sql, params).fetchall(), limit, key="row_key")
+
+
 @app.route("/api/investments/user/<user_id>", methods=["GET"])
 def get_user_investments(user_id):
     try:
-        db = get_db()
-        rows = db.execute("""
-            SELECT name_of_transaction, status
-            FROM estack_transactions
-            WHERE name_of_transaction LIKE ?
-            ORDER BY rowid DESC
-        """, (f"%{user_id}%",)).fetchall()
-
-        results = [{"name_of_transaction": r["name_of_transaction"], "status": r["status"]} for r in rows]
-        return jsonify(results), 200
-
+        limit, after = page_args()
+        fields = field_list(("name_of_transaction", "status"))
+        db = get_db_ro()
+        rows, next_cursor = estack_page_for_user(db, user_id, limit, after)
+
+        results = [
+            project({"name_of_transaction": r["name_of_transaction"], "status": r["status"]}, fields)
+            for r in rows
+        ]
+        return page_response(results, next_cursor)
+
+    except PageError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.exception("Error fetching user investments")
         return jsonify({"error": str(e)}), 500
@@ -2283,17 +2632,22 @@ def get_user_investments(user_id):
 @app.route("/api/investments/status/<deposit_id>", methods=["GET"])
 def get_investment_status(deposit_id):
     try:
-        db = sqlite3.connect("estack.db")
-        db.row_factory = sqlite3.Row
+        cached = status_cache.get("estack", deposit_id)
+        if cached is not None:
+            return jsonify(cached), 200
+
+        version = status_cache.version("estack", deposit_id)
+        db = get_db_ro()
         cur = db.cursor()
 
         # ✅ Match the same table name
-        cur.execute("SELECT status FROM estack_transactions WHERE name_of_transaction LIKE ?", (f"%{deposit_id}%",))
+        cur.execute("SELECT status FROM estack_transactions WHERE deposit_id = ?", (deposit_id,))
         row = cur.fetchone()
-        db.close()
 
         if row:
-            return jsonify({"status": row["status"]}), 200
+            res = {"status": row["status"]}
+            status_cache.fill("estack", deposit_id, res, version)
+            return jsonify(res), 200
         else:
             return jsonify({"error": "Transaction not found"}), 404
 
@@ -2301,6 +2655,18 @@ def get_investment_status(deposit_id):
         print("Error in get_investment_status:", e)
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/investments/status/batch", methods=["POST"])
+def get_investment_status_batch():
+    """{"ids": [...]} -> {deposit_id: status}; one idx_estack_deposit_id lookup per uncached id."""
+    try:
+        ids = batch_ids()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(batch_statuses(
+        "estack", ids, get_db_ro(),
+        "SELECT deposit_id, status FROM estack_transactions WHERE deposit_id IN ({})",
+    )), 200
+
 # # +++++++++++++++++++++++++++++++++++++++
 # # Rerieving loans requests
 # # +++++++++++++++++++++++++++++++++++++++
@@ -2337,16 +2703,41 @@ def get_investment_status(deposit_id):
 #         logger.exception("Error fetching user loans")
 #         return jsonify({"error": str(e)}), 500
 
+@app.route("/debug/export/<table>", methods=["GET"])
+def debug_export(table):
+    """
+    Stream transactions / loans / estack_transactions as NDJSON or CSV.
+    ?format=ndjson|csv&since=&until=&status= ; gzip when the client accepts it.
+    """
+    fmt = request.args.get("format", "ndjson")
+    compress = "gzip" in request.headers.get("Accept-Encoding", "")
+    try:
+        chunks = export.export_chunks(
+            table, fmt,
+            since=request.args.get("since"),
+            until=request.args.get("until"),
+            status=request.args.get("status"),
+            compress=compress,
+        )
+    except export.ExportError as e:
+        return jsonify({"error": str(e)}), 400
+
+    resp = app.response_class(chunks, mimetype=export.FORMATS[fmt])
+    resp.headers["Content-Disposition"] = f"attachment; filename={table}.{fmt}"
+    if compress:
+        resp.headers["Content-Encoding"] = "gzip"
+        resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
 #-----------------------------------
 # GET PENDING REQUESTS
 #----------------------------------
 @app.route("/api/loans/pending", methods=["GET"])
 def get_pending_loans():
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db_sc_ro()
     cur = conn.cursor()
     cur.execute("SELECT loanId, user_id, amount, interest, status, expected_return_date FROM loans WHERE status = ?", ("PENDING",))
     rows = cur.fetchall()
-    conn.close()
 
     loans = []
     for row in rows:
@@ -2361,6 +2752,16 @@ def get_pending_loans():
 
     return jsonify(loans), 200
 
+# -------------------------
+# RUN
+# -------------------------
+
+if __name__ == "__main__":
+    # Schemas are migrated at import (transactions.db) and after the restore (estack.db)
+    port = int(os.environ.get("PORT", 5000))
+    app.run(host="0.0.0.0", port=port)
+
+
 # # -------------------------
 # # DISBURSE LOAN (ADMIN ACTION)
 # # -------------------------
@@ -0,0 +1,98 @@
+"""
+Group-commit vs per-request commit for callback writes.
+
+Replays N eStack-style callbacks (SELECT by deposit_id, then INSERT or
+UPDATE) from T concurrent threads against a throwaway estack.db, once
+with a connection + commit per callback (the old path) and once through
+GroupCommitWriter, and prints throughput and latency for both.
+
+    python benchmarks/bench_group_commit.py [callbacks] [threads]
+"""
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from group_commit import GroupCommitWriter  # noqa: E402
+
+
+def create_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE estack_transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name_of_transaction TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            deposit_id TEXT, user_id TEXT, kind TEXT, amount REAL, currency TEXT,
+            borrower_phone TEXT, investment_id TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX idx_estack_deposit_id ON estack_transactions (deposit_id)")
+    conn.commit()
+    conn.close()
+
+
+def upsert(conn, deposit_id, status):
+    existing = conn.execute(
+        "SELECT 1 FROM estack_transactions WHERE deposit_id = ?", (deposit_id,)
+    ).fetchone()
+    if existing:
+        conn.execute("UPDATE estack_transactions SET status = ? WHERE deposit_id = ?", (status, deposit_id))
+    else:
+        conn.execute(
+            "INSERT INTO estack_transactions (name_of_transaction, status, deposit_id, user_id, kind, amount, currency)"
+            " VALUES (?, ?, ?, 'user', 'investment', 100, 'ZMW')",
+            (f"ZMW100 | user | {deposit_id}", status, deposit_id),
+        )
+
+
+def run(label, enabled, callbacks, threads):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "estack.db")
+        create_db(path)
+        writer = GroupCommitWriter(path, enabled=enabled)
+        latencies = []
+        lock = threading.Lock()
+        per_thread = callbacks // threads
+
+        def worker(n):
+            local = []
+            for i in range(per_thread):
+                # every deposit gets an ACCEPTED then a COMPLETED callback
+                deposit_id = f"dep-{n}-{i // 2}"
+                status = "ACCEPTED" if i % 2 == 0 else "COMPLETED"
+                t0 = time.perf_counter()
+                writer.run(upsert, deposit_id, status)
+                local.append(time.perf_counter() - t0)
+            with lock:
+                latencies.extend(local)
+
+        started = time.perf_counter()
+        pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        total = len(latencies)
+        print(
+            f"{label:<22} {total / elapsed:>9.0f} callbacks/s   "
+            f"p50 {latencies[total // 2] * 1000:6.2f} ms   "
+            f"p99 {latencies[int(total * 0.99)] * 1000:6.2f} ms   "
+            f"batches {writer.stats()['batches'] or total}"
+        )
+
+
+if __name__ == "__main__":
+    callbacks = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    print(f"{callbacks} callbacks from {threads} threads")
+    run("per-request commit", False, callbacks, threads)
+    run("group commit", True, callbacks, threads)
@@ -0,0 +1,102 @@
+"""
+Batch status lookups vs one request per id.
+
+Copies the app modules into a throwaway directory (so the real
+estack.db/transactions.db and Dropbox are never touched), seeds
+transactions and estack_transactions rows, then for each batch size N
+resolves N ids through the Flask test client both as N
+GET /deposit_status/<id> requests and as one POST /deposit_status/batch
+(and likewise for /api/investments/status). The status cache is cleared
+before every run so both paths hit the database.
+
+    python benchmarks/bench_status_batch.py [rows] [rounds]
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import random
+import sqlite3
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SIZES = (1, 10, 50, 100, 200)
+
+
+def load_app(workdir):
+    for path in glob.glob(os.path.join(ROOT, "*.py")):
+        shutil.copy(path, workdir)
+    for var in ("DROPBOX_APP_KEY", "DROPBOX_APP_SECRET", "DROPBOX_REFRESH_TOKEN"):
+        os.environ[var] = ""    # restore fails fast and the app starts on a fresh estack.db
+    os.environ["DROPBOX_SYNC_WINDOW"] = "3600"
+    sys.path.insert(0, workdir)
+    import app  # noqa: E402
+    app.restore_task.wait(10)
+    return app
+
+
+def seed(app, rows):
+    db = sqlite3.connect(app.DATABASE_sc)
+    db.executemany(
+        "INSERT INTO transactions (depositId, status, amount, type) VALUES (?, 'COMPLETED', 10, 'payment')",
+        ((f"dep-{i}",) for i in range(rows)),
+    )
+    db.commit()
+    db.close()
+    db = sqlite3.connect(app.storage.ESTACK_DB)
+    db.executemany(
+        "INSERT INTO estack_transactions (name_of_transaction, status, deposit_id, kind) VALUES (?, 'AVAILABLE', ?, 'investment')",
+        ((f"ZMW10 | u | inv-{i}", f"inv-{i}") for i in range(rows)),
+    )
+    db.commit()
+    db.close()
+
+
+def timed(fn, rounds):
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    workdir = tempfile.mkdtemp(prefix="bench-status-")
+    try:
+        app = load_app(workdir)
+        seed(app, rows)
+        client = app.app.test_client()
+
+        for label, prefix, single, batch, namespace in (
+            ("deposit_status", "dep-", "/deposit_status/{}", "/deposit_status/batch", "transactions"),
+            ("investments/status", "inv-", "/api/investments/status/{}", "/api/investments/status/batch", "estack"),
+        ):
+            print(f"\n{label}: {rows} rows, best of {rounds}")
+            print(f"{'N':>5} {'N requests':>12} {'per id':>10} {'1 batch':>10} {'per id':>10} {'speedup':>8}")
+            for n in SIZES:
+                ids = [f"{prefix}{i}" for i in random.sample(range(rows), n)]
+
+                def singles():
+                    app.status_cache.invalidate(namespace)
+                    for deposit_id in ids:
+                        assert client.get(single.format(deposit_id)).status_code == 200
+
+                def batched():
+                    app.status_cache.invalidate(namespace)
+                    assert client.post(batch, json={"ids": ids}).status_code == 200
+
+                s = timed(singles, rounds)
+                b = timed(batched, rounds)
+                print(f"{n:>5} {s * 1000:>10.2f}ms {s / n * 1e6:>8.0f}us "
+                      f"{b * 1000:>8.2f}ms {b / n * 1e6:>8.0f}us {s / b:>7.1f}x")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
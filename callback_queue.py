@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+# ============================================================
+# 📥 Durable callback queue
+# ------------------------------------------------------------
+# /callback/deposit can acknowledge PawaPay as soon as the raw payload is
+# committed here, and a pool of worker threads applies it afterwards.
+# Delivery is at-least-once: a row claimed by a worker that dies is put
+# back after CLAIM_TIMEOUT. Re-applying the *same* payload is harmless
+# (the eStack/StudyCraft callback logic is an upsert by depositId), but
+# an upsert ignores order, so the queue keeps order itself: a row is
+# only claimed when no earlier row for the same depositId/payoutId is
+# still pending or processing. A retried or requeued older payload
+# therefore holds back the newer ones behind it instead of overwriting
+# them (ACCEPTED can never land after COMPLETED). Rows parked as
+# 'failed' no longer hold anything back.
+#
+# CALLBACK_QUEUE_DB       - SQLite file for the queue (kept out of estack.db,
+#                           which is synced to Dropbox)
+# CALLBACK_WORKERS        - worker threads per process
+# CALLBACK_MAX_ATTEMPTS   - attempts before a row is parked as 'failed'
+# ============================================================
+
+QUEUE_DB = os.getenv(
+    "CALLBACK_QUEUE_DB", os.path.join(os.path.dirname(__file__), "callback_queue.db")
+)
+WORKERS = int(os.getenv("CALLBACK_WORKERS", "2"))
+MAX_ATTEMPTS = int(os.getenv("CALLBACK_MAX_ATTEMPTS", "5"))
+CLAIM_TIMEOUT = 300        # seconds before a 'processing' row is considered abandoned
+RETRY_BACKOFF = 2.0        # seconds, doubled per attempt
+POLL_INTERVAL = 1.0        # seconds; picks up rows enqueued by other processes
+MAINTAIN_INTERVAL = 60     # seconds between abandoned-row / retention sweeps
+DONE_RETENTION = 86400     # seconds to keep applied rows for inspection
+
+logger = logging.getLogger(__name__)
+
+
+class CallbackQueue:
+    """SQLite-backed FIFO of raw callback payloads with a worker pool."""
+
+    def __init__(self, path=QUEUE_DB):
+        self.path = path
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.applied = 0
+        self.retried = 0
+        self.rejected = 0
+        self.last_apply_lag = None
+        self._init_schema()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")   # an acknowledged callback must survive a crash
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS callback_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',   -- pending, processing, done, failed
+                attempts INTEGER NOT NULL DEFAULT 0,
+                received_at REAL NOT NULL,
+                available_at REAL NOT NULL,
+                claimed_at REAL,
+                processed_at REAL,
+                last_error TEXT,
+                callback_key TEXT                           -- depositId/payoutId, orders rows per deposit
+            )
+        """)
+        if "callback_key" not in {r[1] for r in conn.execute("PRAGMA table_info(callback_queue)")}:
+            conn.execute("ALTER TABLE callback_queue ADD COLUMN callback_key TEXT")
+            conn.execute("""
+                UPDATE callback_queue
+                SET callback_key = COALESCE(json_extract(payload, '$.depositId'), json_extract(payload, '$.payoutId'))
+                WHERE status IN ('pending', 'processing')
+            """)
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_callback_queue_status ON callback_queue (status, available_at, id)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_callback_queue_key ON callback_queue (callback_key, id)"
+        )
+
+    def enqueue(self, payload):
+        """Durably append a raw payload. Returns the queue row id."""
+        now = time.time()
+        key = payload.get("depositId") or payload.get("payoutId")
+        cur = self._connect().execute(
+            "INSERT INTO callback_queue (payload, received_at, available_at, callback_key) VALUES (?, ?, ?, ?)",
+            (json.dumps(payload), now, now, str(key) if key is not None else None),
+        )
+        self._wake.set()
+        return cur.lastrowid
+
+    def claim(self):
+        """
+        Atomically take the oldest available row that no earlier row for the same
+        deposit is waiting on. Returns (id, payload, received_at, attempts) or None.
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("""
+                SELECT id, payload, received_at, attempts FROM callback_queue AS q
+                WHERE status = 'pending' AND available_at <= ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM callback_queue AS e
+                      WHERE e.callback_key = q.callback_key AND e.id < q.id
+                        AND e.status IN ('pending', 'processing')
+                  )
+                ORDER BY available_at, id LIMIT 1
+            """, (now,)).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE callback_queue SET status = 'processing', claimed_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    (now, row[0]),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if not row:
+            return None
+        return row[0], json.loads(row[1]), row[2], row[3] + 1
+
+    def complete(self, queue_id, received_at):
+        now = time.time()
+        self._connect().execute(
+            "UPDATE callback_queue SET status = 'done', processed_at = ?, last_error = NULL WHERE id = ?",
+            (now, queue_id),
+        )
+        with self._lock:
+            self.applied += 1
+            self.last_apply_lag = now - received_at
+
+    def fail(self, queue_id, attempts, error, retry=True):
+        """Put a row back for a later retry, or park it as 'failed'."""
+        now = time.time()
+        if retry and attempts < MAX_ATTEMPTS:
+            self._connect().execute(
+                "UPDATE callback_queue SET status = 'pending', available_at = ?, last_error = ? WHERE id = ?",
+                (now + RETRY_BACKOFF * (2 ** (attempts - 1)), str(error), queue_id),
+            )
+            with self._lock:
+                self.retried += 1
+        else:
+            self._connect().execute(
+                "UPDATE callback_queue SET status = 'failed', processed_at = ?, last_error = ? WHERE id = ?",
+                (now, str(error), queue_id),
+            )
+            with self._lock:
+                self.rejected += 1
+
+    def requeue_abandoned(self):
+        """Return rows stuck in 'processing' (worker crashed mid-apply) to the queue."""
+        cur = self._connect().execute(
+            "UPDATE callback_queue SET status = 'pending' WHERE status = 'processing' AND claimed_at < ?",
+            (time.time() - CLAIM_TIMEOUT,),
+        )
+        if cur.rowcount:
+            logger.warning("Requeued %d abandoned callbacks", cur.rowcount)
+        return cur.rowcount
+
+    def maintain(self):
+        """Requeue abandoned rows and drop applied rows past DONE_RETENTION."""
+        self.requeue_abandoned()
+        self._connect().execute(
+            "DELETE FROM callback_queue WHERE status = 'done' AND processed_at < ?",
+            (time.time() - DONE_RETENTION,),
+        )
+
+    def process_one(self, handler):
+        """
+        Claim and apply one row. handler(payload) returns True when applied,
+        False when the payload can never apply (no retry), or raises to retry.
+        Returns False when the queue had nothing available.
+        """
+        item = self.claim()
+        if item is None:
+            return False
+        queue_id, payload, received_at, attempts = item
+        try:
+            if handler(payload):
+                self.complete(queue_id, received_at)
+            else:
+                self.fail(queue_id, attempts, "rejected by handler", retry=False)
+        except Exception as e:
+            logger.exception("Callback %s failed (attempt %d)", queue_id, attempts)
+            self.fail(queue_id, attempts, e)
+        return True
+
+    def _run(self, handler, wait_for):
+        if wait_for is not None:
+            wait_for()
+        next_maintenance = time.time() + MAINTAIN_INTERVAL
+        while not self._stop.is_set():
+            try:
+                if self.process_one(handler):
+                    continue
+                if time.time() >= next_maintenance:
+                    self.maintain()
+                    next_maintenance = time.time() + MAINTAIN_INTERVAL
+            except sqlite3.Error:
+                logger.exception("Callback queue error")
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+
+    def start(self, handler, workers=WORKERS, wait_for=None):
+        """Start the worker pool. wait_for() blocks until the target databases are ready."""
+        if self._threads:
+            return
+        self.maintain()
+        self._stop.clear()
+        for i in range(workers):
+            t = threading.Thread(
+                target=self._run, args=(handler, wait_for), name=f"callback-worker-{i}", daemon=True
+            )
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def stats(self):
+        conn = self._connect()
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM callback_queue GROUP BY status").fetchall())
+        oldest = conn.execute(
+            "SELECT MIN(received_at) FROM callback_queue WHERE status IN ('pending', 'processing')"
+        ).fetchone()[0]
+        with self._lock:
+            return {
+                "depth": counts.get("pending", 0) + counts.get("processing", 0),
+                "pending": counts.get("pending", 0),
+                "processing": counts.get("processing", 0),
+                "failed": counts.get("failed", 0),
+                "done": counts.get("done", 0),
+                "oldest_pending_age_seconds": round(time.time() - oldest, 3) if oldest else 0.0,
+                "last_apply_lag_seconds": round(self.last_apply_lag, 3) if self.last_apply_lag is not None else None,
+                "applied": self.applied,
+                "retried": self.retried,
+                "rejected": self.rejected,
+                "workers": len(self._threads),
+            }
@@ -0,0 +1,95 @@
+import time
+import threading
+from collections import OrderedDict
+
+import storage
+
+# ============================================================
+# ♻️ Processed-callback registry
+# ------------------------------------------------------------
+# PawaPay re-delivers callbacks. Every (depositId|payoutId, status) pair
+# that has been applied is remembered in an in-memory LRU backed by the
+# processed_callbacks table (created by migrations.py), so an exact
+# duplicate can be answered without touching the main tables or
+# scheduling a Dropbox sync.
+# ============================================================
+
+CAPACITY = 10000
+
+
+class ProcessedCallbackRegistry:
+    """LRU of applied (callback id, status) pairs with a persistent fallback table."""
+
+    def __init__(self, db_path, writer=None, capacity=CAPACITY):
+        self.db_path = db_path
+        self.writer = writer        # GroupCommitWriter for db_path; records are written through it
+        self.capacity = capacity
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = storage.SharedConnection(db_path)     # closed by storage.invalidate()
+        self.checks = 0
+        self.memory_hits = 0
+        self.table_hits = 0
+
+    @staticmethod
+    def key(callback_id, status):
+        return str(callback_id), str(status or "").strip().upper()
+
+    def _remember(self, key):
+        with self._lock:
+            self._lru[key] = True
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.capacity:
+                self._lru.popitem(last=False)
+
+    def seen(self, callback_id, status):
+        """True if this exact (id, status) callback has already been applied."""
+        key = self.key(callback_id, status)
+        with self._lock:
+            self.checks += 1
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self.memory_hits += 1
+                return True
+        with self._conn.use() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM processed_callbacks WHERE callback_id = ? AND status = ?", key
+            ).fetchone()
+        if row:
+            with self._lock:
+                self.table_hits += 1
+            self._remember(key)
+            return True
+        return False
+
+    def record(self, callback_id, status, source=None):
+        """Remember an applied callback. The table write is batched and not waited on."""
+        key = self.key(callback_id, status)
+        self._remember(key)
+        params = (key[0], key[1], source, time.time())
+        if self.writer is not None:
+            self.writer.submit(_insert_processed, *params)
+        else:
+            with self._conn.use() as conn:
+                _insert_processed(conn, *params)
+                conn.commit()
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.table_hits
+            return {
+                "checks": self.checks,
+                "duplicates": hits,
+                "duplicate_hit_rate": round(hits / self.checks, 4) if self.checks else 0.0,
+                "memory_hits": self.memory_hits,
+                "table_hits": self.table_hits,
+                "lru_size": len(self._lru),
+                "lru_capacity": self.capacity,
+            }
+
+
+def _insert_processed(conn, callback_id, status, source, processed_at):
+    conn.execute(
+        "INSERT OR IGNORE INTO processed_callbacks (callback_id, status, source, processed_at) VALUES (?, ?, ?, ?)",
+        (callback_id, status, source, processed_at),
+    )
@@ -1,6 +1,25 @@
 import os
+import json
+import gzip
+import time
+import zlib
+import atexit
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
 import dropbox
 
+import storage
+
+try:
+    import fcntl
+except ImportError:     # not on Windows; restores are then only serialized within a process
+    fcntl = None
+
 # ============================================================
 # 🔐 1️⃣ Environment Variables Required
 # ------------------------------------------------------------
@@ -10,8 +29,31 @@ import dropbox
 # DROPBOX_REFRESH_TOKEN=your_refresh_token
 # ============================================================
 
-DBX_PATH = "/estack.db"
-LOCAL_DB = "estack.db"
+DBX_PATH = "/estack.db"          # legacy raw copy (still read on download)
+DBX_GZ_PATH = "/estack.db.gz"    # gzip-compressed snapshot (written on upload)
+LOCAL_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "estack.db")
+SYNC_STATE = LOCAL_DB + ".sync.json"   # Dropbox rev/content_hash of the last synced copy
+RESTORE_LOCK = LOCAL_DB + ".restore.lock"  # held by the one worker that restores at a time
+
+RETIRE_ATTEMPTS = 5              # checkpoint tries before a restore is refused
+RETIRE_RETRY_DELAY = 1.0         # seconds, doubled per try
+
+CHUNK_SIZE = 1024 * 1024         # streaming buffer for compress / hash / download
+BACKUP_PAGES = 1024              # pages copied per sqlite backup step
+
+# Files above UPLOAD_SESSION_THRESHOLD go through a Dropbox upload session in
+# UPLOAD_CHUNK_SIZE pieces (single files_upload calls are capped at 150 MB).
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_SESSION_THRESHOLD = 2 * UPLOAD_CHUNK_SIZE
+
+# sha256 of the last snapshot successfully uploaded (seeded from SYNC_STATE)
+_last_uploaded_hash = None
+
+# Background sync tuning (seconds):
+# SYNC_WINDOW   - writes within this window after the first dirty mark are coalesced
+# SYNC_INTERVAL - minimum time between two uploads
+SYNC_WINDOW = float(os.getenv("DROPBOX_SYNC_WINDOW", "5"))
+SYNC_INTERVAL = float(os.getenv("DROPBOX_SYNC_INTERVAL", "30"))
 
 def get_dbx():
     """Safely create Dropbox client using refresh token (auto-refresh forever)"""
@@ -30,33 +72,472 @@ def get_dbx():
     return dbx
 
 
+def snapshot_db(dest_path):
+    """
+    Copy LOCAL_DB into dest_path with the sqlite3 online backup API.
+    Gives a transactionally consistent copy even while other threads write,
+    and copies in BACKUP_PAGES steps so writers are not locked out for the
+    whole copy.
+    """
+    if not os.path.exists(LOCAL_DB):
+        raise FileNotFoundError(LOCAL_DB)
+    src = sqlite3.connect(LOCAL_DB)
+    dst = sqlite3.connect(dest_path)
+    try:
+        src.backup(dst, pages=BACKUP_PAGES)
+    finally:
+        dst.close()
+        src.close()
+
+
+def compress_file(src_path, dest_path):
+    """Gzip src_path into dest_path as a stream. Returns (sha256 of raw content, raw size, gz size)."""
+    digest = hashlib.sha256()
+    raw_size = 0
+    with open(src_path, "rb") as src, open(dest_path, "wb") as raw_dest:
+        # mtime=0 keeps the gzip output identical for identical input
+        with gzip.GzipFile(fileobj=raw_dest, mode="wb", mtime=0) as dest:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                raw_size += len(chunk)
+                dest.write(chunk)
+    return digest.hexdigest(), raw_size, os.path.getsize(dest_path)
+
+
+def _report_progress(label, done, total, started):
+    """Print transfer progress and throughput."""
+    elapsed = max(time.time() - started, 1e-6)
+    rate = done / elapsed / (1024 * 1024)
+    if total:
+        print(f"   {label}: {done}/{total} bytes ({done * 100 // total}%) at {rate:.2f} MB/s")
+    else:
+        print(f"   {label}: {done} bytes at {rate:.2f} MB/s")
+
+
+def upload_file(dbx, local_path, dbx_path):
+    """
+    Upload local_path to dbx_path with bounded memory.
+    Small files go up in one request; larger ones use an upload session
+    with UPLOAD_CHUNK_SIZE chunks. Returns the uploaded FileMetadata.
+    """
+    size = os.path.getsize(local_path)
+    mode = dropbox.files.WriteMode("overwrite")
+    started = time.time()
+
+    with open(local_path, "rb") as f:
+        if size <= UPLOAD_SESSION_THRESHOLD:
+            metadata = dbx.files_upload(f.read(), dbx_path, mode=mode)
+            _report_progress("upload", size, size, started)
+            return metadata
+
+        session = dbx.files_upload_session_start(f.read(UPLOAD_CHUNK_SIZE))
+        cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=f.tell())
+        commit = dropbox.files.CommitInfo(path=dbx_path, mode=mode)
+
+        while size - f.tell() > UPLOAD_CHUNK_SIZE:
+            dbx.files_upload_session_append_v2(f.read(UPLOAD_CHUNK_SIZE), cursor)
+            cursor.offset = f.tell()
+            _report_progress("upload", cursor.offset, size, started)
+
+        metadata = dbx.files_upload_session_finish(f.read(UPLOAD_CHUNK_SIZE), cursor, commit)
+        _report_progress("upload", size, size, started)
+        return metadata
+
+
+class RestoreRefused(RuntimeError):
+    """The local database stayed busy, so the downloaded copy was not put in place."""
+
+
+def retire_local_db(path):
+    """
+    Prepare path to be replaced by a downloaded copy: close this process's
+    connections to it (storage.invalidate) and fold its WAL back into the
+    main file, so no committed write lives only in a -wal that would then
+    belong to the new file. Retries while another connection (e.g. another
+    worker process) is still reading or writing it, then raises
+    RestoreRefused; the old file is left in place.
+    """
+    if not os.path.exists(path):
+        return
+    delay = RETIRE_RETRY_DELAY
+    for attempt in range(RETIRE_ATTEMPTS):
+        storage.invalidate(path)
+        conn = sqlite3.connect(path, timeout=storage.BUSY_TIMEOUT_MS / 1000)
+        try:
+            busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        finally:
+            conn.close()
+        if not busy:
+            return
+        if attempt < RETIRE_ATTEMPTS - 1:
+            time.sleep(delay)
+            delay *= 2
+    raise RestoreRefused(
+        f"{os.path.basename(path)} is in use; WAL not checkpointed after {RETIRE_ATTEMPTS} tries, keeping the local copy"
+    )
+
+
+def _inflate(inflater, chunk, f):
+    """
+    Write chunk's decompressed bytes to f at most CHUNK_SIZE at a time, so a
+    highly compressible chunk (long zero runs in free pages) never expands
+    in memory all at once.
+    """
+    f.write(inflater.decompress(chunk, CHUNK_SIZE))
+    while inflater.unconsumed_tail:
+        f.write(inflater.decompress(inflater.unconsumed_tail, CHUNK_SIZE))
+
+
+def download_file(dbx, dbx_path, local_path, decompress=False, progress=None):
+    """
+    Stream dbx_path to local_path in CHUNK_SIZE pieces, optionally gunzipping
+    on the fly. Writes to a temp file and renames it into place, so a failed
+    transfer never leaves a truncated database behind.
+    progress(bytes_received, bytes_total) is called after every chunk.
+    """
+    metadata, res = dbx.files_download(dbx_path)
+    tmp_path = f"{local_path}.{os.getpid()}.download"
+    inflater = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS) if decompress else None
+    started = time.time()
+    received = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                received += len(chunk)
+                if inflater:
+                    _inflate(inflater, chunk, f)
+                else:
+                    f.write(chunk)
+                if progress:
+                    progress(received, metadata.size)
+            if inflater:
+                f.write(inflater.flush())
+        retire_local_db(local_path)
+        os.replace(tmp_path, local_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        res.close()
+    _report_progress("download", received, metadata.size, started)
+    return metadata
+
+
+def load_sync_state():
+    """Return the persisted sync state, or {} if there is none."""
+    try:
+        with open(SYNC_STATE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_sync_state(dbx_path, metadata, snapshot_sha256=None):
+    """Persist which Dropbox revision the local estack.db now corresponds to."""
+    state = {
+        "path": dbx_path,
+        "rev": getattr(metadata, "rev", None),
+        "content_hash": getattr(metadata, "content_hash", None),
+        "snapshot_sha256": snapshot_sha256,
+        "synced_at": datetime.now(timezone.utc).isoformat(),
+    }
+    tmp_path = f"{SYNC_STATE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, SYNC_STATE)
+
+
+def get_remote_metadata(dbx):
+    """Return (dbx_path, FileMetadata) of the copy download_db would fetch, or (None, None)."""
+    for dbx_path in (DBX_GZ_PATH, DBX_PATH):
+        try:
+            return dbx_path, dbx.files_get_metadata(dbx_path)
+        except dropbox.exceptions.ApiError:
+            continue
+    return None, None
+
+
 def upload_db():
-    """Upload local estack.db to Dropbox"""
+    """
+    Upload a consistent, gzip-compressed snapshot of estack.db to Dropbox.
+    Skips the upload when the snapshot is identical to the last one sent.
+    Returns True on success (including skipped uploads).
+    """
+    global _last_uploaded_hash
+    if _last_uploaded_hash is None:
+        _last_uploaded_hash = load_sync_state().get("snapshot_sha256")
     try:
-        dbx = get_dbx()
-        with open(LOCAL_DB, "rb") as f:
-            dbx.files_upload(f.read(), DBX_PATH, mode=dropbox.files.WriteMode("overwrite"))
-        print("✅ estack.db uploaded to Dropbox.")
+        with tempfile.TemporaryDirectory(prefix="estack-sync-") as tmp:
+            snapshot = os.path.join(tmp, "estack.db")
+            snapshot_db(snapshot)
+            compressed = snapshot + ".gz"
+            digest, raw_size, gz_size = compress_file(snapshot, compressed)
+
+            if digest == _last_uploaded_hash:
+                print("⏭️ estack.db unchanged since last upload, skipping.")
+                return True
+
+            dbx = get_dbx()
+            metadata = upload_file(dbx, compressed, DBX_GZ_PATH)
+
+        _last_uploaded_hash = digest
+        save_sync_state(DBX_GZ_PATH, metadata, snapshot_sha256=digest)
+        print(f"✅ estack.db uploaded to Dropbox ({raw_size} bytes → {gz_size} gzipped).")
+        return True
     except FileNotFoundError:
         print("⚠️ Local estack.db not found for upload.")
     except Exception as e:
         print("❌ Dropbox upload failed:", e)
+    return False
 
 
-def download_db():
-    """Download estack.db from Dropbox (run on app startup)"""
+def download_db(progress=None):
+    """
+    Download estack.db from Dropbox (run on app startup).
+    Prefers the compressed snapshot and falls back to the legacy raw copy.
+    Only remote metadata is fetched when the local copy already matches the
+    Dropbox rev/content_hash recorded at the last sync. Download errors are
+    reported and the local copy is used; RestoreRefused is raised so the
+    restore is reported as failed rather than ready.
+    """
     try:
         dbx = get_dbx()
-        metadata, res = dbx.files_download(DBX_PATH)
-        with open(LOCAL_DB, "wb") as f:
-            f.write(res.content)
+        dbx_path, metadata = get_remote_metadata(dbx)
+        if metadata is None:
+            print("⚠️ No existing estack.db found in Dropbox (starting fresh).")
+            return
+
+        state = load_sync_state()
+        if os.path.exists(LOCAL_DB) and state.get("path") == dbx_path and (
+            state.get("rev") == metadata.rev or state.get("content_hash") == metadata.content_hash
+        ):
+            print(f"✅ Local estack.db already matches Dropbox rev {metadata.rev}, skipping download.")
+            return
+
+        metadata = download_file(
+            dbx, dbx_path, LOCAL_DB, decompress=dbx_path == DBX_GZ_PATH, progress=progress
+        )
+        save_sync_state(dbx_path, metadata)
         print("✅ estack.db downloaded from Dropbox.")
     except dropbox.exceptions.ApiError:
         print("⚠️ No existing estack.db found in Dropbox (starting fresh).")
+    except RestoreRefused:
+        raise
     except Exception as e:
         print("❌ Dropbox download failed:", e)
 
 
+@contextmanager
+def restore_lock():
+    """
+    Serialize restores across the worker processes of one host. Every worker
+    runs the restore at import; the first one to get the lock downloads,
+    the others then find the local copy already at the Dropbox rev and skip.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(RESTORE_LOCK, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class RestoreTask:
+    """
+    Runs download_db() in a background thread so the web server can start
+    answering immediately, then calls on_restored() (schema init) and marks
+    the database ready. status() reports progress for the /ready endpoint.
+    """
+
+    def __init__(self):
+        self._ready = threading.Event()
+        self._thread = None
+        self.state = "pending"    # pending -> restoring -> initializing -> ready | failed
+        self.bytes_done = 0
+        self.bytes_total = None
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def start(self, on_restored=None):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, args=(on_restored,), name="estack-restore", daemon=True
+        )
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def _progress(self, done, total):
+        self.bytes_done = done
+        self.bytes_total = total
+
+    def _run(self, on_restored):
+        self.started_at = time.time()
+        try:
+            self.state = "restoring"
+            print("⏬ Checking Dropbox for latest estack.db...")
+            with restore_lock():
+                download_db(progress=self._progress)
+            self.state = "initializing"
+            if on_restored:
+                on_restored()
+            self.state = "ready"
+            self._ready.set()
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            print("❌ estack.db restore failed:", e)
+        finally:
+            self.finished_at = time.time()
+
+    def status(self):
+        end = self.finished_at or time.time()
+        return {
+            "ready": self.ready,
+            "state": self.state,
+            "bytes_done": self.bytes_done,
+            "bytes_total": self.bytes_total,
+            "elapsed_seconds": round(end - self.started_at, 3) if self.started_at else None,
+            "error": self.error,
+        }
+
+
+restore_task = RestoreTask()
+
+
+class SyncWorker:
+    """
+    Debounced background uploader for estack.db.
+    Request handlers call mark_dirty(); a daemon thread coalesces all marks
+    within SYNC_WINDOW into one upload, never uploads more than once per
+    SYNC_INTERVAL, and flushes pending changes on shutdown.
+    """
+
+    def __init__(self, upload=upload_db, window=SYNC_WINDOW, interval=SYNC_INTERVAL):
+        self.upload = upload
+        self.window = window
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.dirty_since = None   # time of the oldest change not yet uploaded
+        self.last_sync = None     # time of the last successful upload
+        self.last_attempt = None  # time of the last upload attempt (gates SYNC_INTERVAL)
+        self.marks = 0
+        self.uploads = 0
+        self.failures = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="dropbox-sync", daemon=True)
+            self._thread.start()
+
+    def mark_dirty(self):
+        """Record that estack.db changed. Cheap; never touches the network."""
+        with self._lock:
+            if self.dirty_since is None:
+                self.dirty_since = time.time()
+            self.marks += 1
+        self._wake.set()
+        if not (self._thread and self._thread.is_alive()):
+            self.start()
+
+    def _due_at(self):
+        due = self.dirty_since + self.window
+        if self.last_attempt is not None:
+            due = max(due, self.last_attempt + self.interval)
+        return due
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait()
+            self._wake.clear()
+            while not self._stop.is_set():
+                with self._lock:
+                    if self.dirty_since is None:
+                        break
+                    delay = self._due_at() - time.time()
+                if delay > 0:
+                    self._stop.wait(delay)
+                    continue
+                self.sync()
+
+    def sync(self):
+        """Upload now if there are pending changes. Returns False only if the upload failed."""
+        with self._lock:
+            pending_since = self.dirty_since
+            if pending_since is None:
+                return True
+            self.dirty_since = None
+            self.last_attempt = time.time()
+
+        ok = self.upload()
+        with self._lock:
+            if ok:
+                self.last_sync = time.time()
+                self.uploads += 1
+            else:
+                # Stay dirty from the original timestamp; the next attempt waits a full interval
+                self.failures += 1
+                self.dirty_since = pending_since
+        return ok
+
+    def stop(self, flush=True):
+        """Stop the worker thread and upload any pending changes."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=5)
+        if flush and self.dirty_since is not None:
+            print("⏫ Flushing pending estack.db changes to Dropbox before shutdown...")
+            self.sync()
+
+    def status(self):
+        with self._lock:
+            now = time.time()
+            return {
+                "dirty": self.dirty_since is not None,
+                "lag_seconds": round(now - self.dirty_since, 3) if self.dirty_since else 0.0,
+                "last_sync_at": (
+                    datetime.fromtimestamp(self.last_sync, timezone.utc).isoformat()
+                    if self.last_sync else None
+                ),
+                "seconds_since_sync": round(now - self.last_sync, 3) if self.last_sync else None,
+                "window_seconds": self.window,
+                "interval_seconds": self.interval,
+                "marks": self.marks,
+                "uploads": self.uploads,
+                "failures": self.failures,
+            }
+
+
+sync_worker = SyncWorker()
+atexit.register(sync_worker.stop)
+
+
+def mark_db_dirty():
+    """Schedule a debounced background upload of estack.db."""
+    sync_worker.mark_dirty()
+
+
 # import os
 # import dropbox
 
@@ -0,0 +1,184 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+from collections import deque
+
+import storage
+
+# ============================================================
+# 📡 Deposit status events (long-poll + SSE)
+# ------------------------------------------------------------
+# /deposit_status/<id>?wait=N and /events/deposits/<id> subscribe here
+# and block on their subscription's own Event until a status change for
+# that id arrives; publishing wakes only the waiters on that id. A
+# waiter holds no DB connection and the registry runs no thread per
+# waiter:
+#
+# - deposit_callback publishes each status it commits, immediately;
+# - one watcher thread per process notices commits made by *other*
+#   processes (PRAGMA data_version on a read-only connection) and
+#   re-reads only the ids that currently have waiters, in one query.
+#
+# An idle waiter still occupies its request. On the default gthread
+# workers that is a request thread, so DEPOSIT_WAITERS_MAX defaults to
+# half of GUNICORN_THREADS; with GUNICORN_WORKER_CLASS=gevent a waiter
+# is a parked greenlet and the default is 1000 (see gunicorn.conf.py for
+# the trade-offs). Beyond the cap long-polls answer immediately and SSE
+# returns 503.
+#
+# DEPOSIT_WAITERS_MAX        - concurrent subscriptions per process
+# DEPOSIT_WATCH_INTERVAL_MS  - how often the watcher checks for commits
+# ============================================================
+
+_GREENLETS = os.getenv("GUNICORN_WORKER_CLASS", "gthread") == "gevent"
+MAX_WAITERS = int(os.getenv(
+    "DEPOSIT_WAITERS_MAX", "1000" if _GREENLETS else str(max(1, int(os.getenv("GUNICORN_THREADS", "32")) // 2))
+))
+WATCH_INTERVAL = float(os.getenv("DEPOSIT_WATCH_INTERVAL_MS", "250")) / 1000
+LOOKUP_CHUNK = 500          # ids per IN (...) query
+
+logger = logging.getLogger(__name__)
+
+
+class TooManyWaiters(Exception):
+    pass
+
+
+class Subscription:
+    """One waiter's view of the events for a deposit id."""
+
+    def __init__(self, registry, deposit_id):
+        self.registry = registry
+        self.deposit_id = deposit_id
+        self.events = deque(maxlen=32)
+        self._ready = threading.Event()     # set while events is non-empty
+
+    def next(self, timeout):
+        """The next event, or None if none arrived within timeout seconds."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.registry._lock:
+                if self.events:
+                    event = self.events.popleft()
+                    if not self.events:
+                        self._ready.clear()
+                    return event
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._ready.wait(remaining):
+                return None
+
+    def close(self):
+        self.registry.unsubscribe(self)
+
+
+class DepositEvents:
+    """Per-deposit waiter registry fed by the callback path and a commit watcher."""
+
+    def __init__(self, max_waiters=MAX_WAITERS):
+        self.max_waiters = max_waiters
+        self._lock = threading.Lock()
+        self._subs = {}         # deposit_id -> set of Subscription
+        self._last = {}         # deposit_id -> last published status (watched ids only)
+        self._thread = None
+        self._stop = threading.Event()
+        self.published = 0
+        self.rejected = 0
+        self.watch_queries = 0
+
+    def subscribe(self, deposit_id):
+        deposit_id = str(deposit_id)
+        with self._lock:
+            if self.waiters() >= self.max_waiters:
+                self.rejected += 1
+                raise TooManyWaiters(f"{self.max_waiters} deposit waiters already open")
+            sub = Subscription(self, deposit_id)
+            self._subs.setdefault(deposit_id, set()).add(sub)
+            return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subs.get(sub.deposit_id)
+            if subs is None:
+                return
+            subs.discard(sub)
+            if not subs:
+                del self._subs[sub.deposit_id]
+                self._last.pop(sub.deposit_id, None)
+
+    def waiters(self):
+        return sum(len(s) for s in self._subs.values())
+
+    def publish(self, deposit_id, event):
+        """Deliver event (a dict with "status") to every waiter on deposit_id; repeats are dropped."""
+        deposit_id = str(deposit_id)
+        with self._lock:
+            subs = self._subs.get(deposit_id)
+            if not subs or self._last.get(deposit_id) == event.get("status"):
+                return
+            self._last[deposit_id] = event.get("status")
+            for sub in subs:
+                sub.events.append(event)
+                sub._ready.set()
+            self.published += 1
+
+    # -------------------------
+    # Cross-process watcher
+    # -------------------------
+    def start(self, sources):
+        """
+        Watch other processes' commits. sources: [(db_path, sql, source_name)] where
+        sql selects (id, status) and has one "{}" for the IN (...) placeholders.
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, args=(sources,), name="deposit-events", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self, sources):
+        # Closed by storage.invalidate() when a restore replaces the file
+        conns = {db_path: storage.SharedConnection(db_path, readonly=True) for db_path, _, _ in sources}
+        seen = {}       # db_path -> (connection opens, data_version) at the last refresh
+        while not self._stop.wait(WATCH_INTERVAL):
+            with self._lock:
+                ids = list(self._subs)
+            if not ids:
+                continue
+            for db_path, sql, source in sources:
+                shared = conns[db_path]
+                try:
+                    with shared.use() as conn:
+                        version = (shared.opens, conn.execute("PRAGMA data_version").fetchone()[0])
+                        if seen.get(db_path) != version:
+                            seen[db_path] = version
+                            self._refresh(conn, sql, source, ids)
+                except sqlite3.Error:
+                    logger.exception("Deposit watcher failed on %s", os.path.basename(db_path))
+                    seen.pop(db_path, None)
+
+    def _refresh(self, conn, sql, source, ids):
+        for i in range(0, len(ids), LOOKUP_CHUNK):
+            chunk = ids[i:i + LOOKUP_CHUNK]
+            rows = conn.execute(sql.format(",".join("?" * len(chunk))), chunk).fetchall()
+            self.watch_queries += 1
+            for deposit_id, status in rows:
+                self.publish(deposit_id, {"depositId": deposit_id, "status": status, "source": source})
+
+    def stats(self):
+        with self._lock:
+            return {
+                "deposits_watched": len(self._subs),
+                "waiters": self.waiters(),
+                "max_waiters": self.max_waiters,
+                "published": self.published,
+                "rejected": self.rejected,
+                "watch_queries": self.watch_queries,
+            }
+
+
+deposit_events = DepositEvents()
@@ -0,0 +1,157 @@
+"""
+Streaming export of transactions, loans and estack_transactions.
+
+Rows are read through a server-side cursor (fetchmany) on a dedicated
+read-only connection and encoded straight into ~64 KB NDJSON or CSV
+chunks, optionally gzip-compressed on the fly, so memory stays flat no
+matter how many rows are exported. Served by /debug/export/<table> and
+usable from the command line:
+
+    python export.py transactions --format csv --since 2025-01-01 \\
+        --status COMPLETED -o transactions.csv.gz
+"""
+import io
+import csv
+import sys
+import json
+import zlib
+import argparse
+
+import storage
+
+# table -> (database, date the since/until filters apply to). A row's date is
+# its last change, falling back to when it was created: older rows and rows
+# written outside the callback path have no updated_at/received_at.
+EXPORT_TABLES = {
+    "transactions": (storage.TRANSACTIONS_DB, "COALESCE(updated_at, received_at, created_at)"),
+    "loans": (storage.TRANSACTIONS_DB, "COALESCE(updated_at, created_at)"),
+    "estack_transactions": (storage.ESTACK_DB, "created_at"),
+}
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+FETCH_ROWS = 1000           # rows per fetchmany()
+CHUNK_BYTES = 64 * 1024     # encoded bytes buffered before each yield
+
+
+class ExportError(ValueError):
+    """Unknown table/format; the message is safe to return as a 400."""
+
+
+def build_query(table, since=None, until=None, status=None):
+    """SELECT for one export, oldest first. since is inclusive, until exclusive (ISO strings)."""
+    if table not in EXPORT_TABLES:
+        raise ExportError(f"Unknown table {table!r}; expected one of {', '.join(EXPORT_TABLES)}")
+    _, date_expr = EXPORT_TABLES[table]
+    clauses, params = [], []
+    if since:
+        clauses.append(f"{date_expr} >= ?")
+        params.append(since)
+    if until:
+        clauses.append(f"{date_expr} < ?")
+        params.append(until)
+    if status:
+        clauses.append("status = ?")
+        params.append(status)
+    sql = f"SELECT * FROM {table}"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    return sql + " ORDER BY rowid", params
+
+
+def _encode_ndjson(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), default=str) + "\n"
+
+
+def _encode_csv(columns, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def _fetch(cursor):
+    while True:
+        rows = cursor.fetchmany(FETCH_ROWS)
+        if not rows:
+            return
+        yield from rows
+
+
+def export_chunks(table, fmt="ndjson", since=None, until=None, status=None, compress=False):
+    """Yield the encoded (and optionally gzipped) export as bytes chunks."""
+    if fmt not in FORMATS:
+        raise ExportError(f"Unknown format {fmt!r}; expected one of {', '.join(FORMATS)}")
+    sql, params = build_query(table, since, until, status)
+    db_path, _ = EXPORT_TABLES[table]
+    # Opened (and the query prepared) before the first chunk, so errors surface before a response starts
+    conn = storage.connect(db_path, readonly=True)
+    conn.row_factory = None     # plain tuples; column names come from cursor.description
+    # A full-table scan would otherwise fill the mmap window and page cache (worker RSS)
+    conn.execute("PRAGMA mmap_size=0")
+    conn.execute("PRAGMA cache_size=-2000")
+    try:
+        cursor = conn.execute(sql, params)
+    except Exception:
+        conn.close()
+        raise
+    return _stream(conn, cursor, fmt, compress)
+
+
+def _stream(conn, cursor, fmt, compress):
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    try:
+        columns = [d[0] for d in cursor.description]
+        encode = _encode_csv if fmt == "csv" else _encode_ndjson
+        pending, size = [], 0
+        for text in encode(columns, _fetch(cursor)):
+            pending.append(text)
+            size += len(text)
+            if size >= CHUNK_BYTES:
+                data = "".join(pending).encode("utf-8")
+                pending, size = [], 0
+                data = gz.compress(data) if gz else data
+                if data:
+                    yield data
+        data = "".join(pending).encode("utf-8")
+        if gz:
+            data = gz.compress(data) + gz.flush()
+        if data:
+            yield data
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream a table export as NDJSON or CSV.")
+    parser.add_argument("table", choices=sorted(EXPORT_TABLES))
+    parser.add_argument("--format", choices=sorted(FORMATS), default="ndjson")
+    parser.add_argument("--since", help="inclusive lower bound on the row's last-changed/created date (ISO)")
+    parser.add_argument("--until", help="exclusive upper bound on the row's last-changed/created date (ISO)")
+    parser.add_argument("--status", help="only rows with this status")
+    parser.add_argument("-o", "--output", help="output file (gzip if it ends in .gz); default stdout")
+    args = parser.parse_args(argv)
+
+    compress = bool(args.output and args.output.endswith(".gz"))
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in export_chunks(args.table, args.format, args.since, args.until, args.status, compress):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+        else:
+            out.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+import storage
+
+# ============================================================
+# 🧺 Group-commit writer
+# ------------------------------------------------------------
+# Callback handlers hand their SELECT/INSERT/UPDATE work to a single
+# writer thread per database file. The writer drains whatever is queued
+# (up to MAX_BATCH mutations, optionally waiting MAX_DELAY for more),
+# runs each mutation inside its own SAVEPOINT and commits the whole
+# batch once. Each caller blocks until its batch is committed, so a
+# 200 still means "durably written", but N concurrent callbacks cost
+# one fsync instead of N.
+#
+# CALLBACK_GROUP_COMMIT=0      - fall back to one connection + commit per call
+# GROUP_COMMIT_MAX_BATCH       - mutations per transaction
+# GROUP_COMMIT_MAX_DELAY_MS    - extra wait to fill a batch (0 = no added latency)
+# ============================================================
+
+ENABLED = os.getenv("CALLBACK_GROUP_COMMIT", "1") != "0"
+MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "64"))
+MAX_DELAY = float(os.getenv("GROUP_COMMIT_MAX_DELAY_MS", "0")) / 1000
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCommitWriter:
+    """Serializes mutations on one SQLite file and commits them in batches."""
+
+    def __init__(self, path, enabled=ENABLED, max_batch=MAX_BATCH, max_delay=MAX_DELAY):
+        self.path = path
+        self.enabled = enabled
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._conn = storage.SharedConnection(path, isolation_level=None)    # the writer thread's
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.mutations = 0
+        self.max_seen_batch = 0
+
+    def _connect(self):
+        return storage.connect(self.path, isolation_level=None)
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if not (self._thread and self._thread.is_alive()):
+                self._thread = threading.Thread(
+                    target=self._run, name=f"group-commit-{os.path.basename(self.path)}", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, fn, *args):
+        """Queue fn(conn, *args). Returns a Future resolved after the batch commits."""
+        future = Future()
+        if not self.enabled:
+            try:
+                future.set_result(self._run_single(fn, args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self._ensure_started()
+        self._queue.put((fn, args, future))
+        return future
+
+    def run(self, fn, *args):
+        """Run fn(conn, *args) in the next batch and return its result once committed."""
+        return self.submit(fn, *args).result()
+
+    def _run_single(self, fn, args):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            result = fn(conn, *args)
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            done = []
+            try:
+                # Rolls back on failure; reopened after a restore replaces the file
+                with self._conn.use() as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    for fn, args, future in batch:
+                        conn.execute("SAVEPOINT mutation")
+                        try:
+                            result = fn(conn, *args)
+                            conn.execute("RELEASE mutation")
+                            done.append((future, result))
+                        except Exception as e:
+                            conn.execute("ROLLBACK TO mutation")
+                            conn.execute("RELEASE mutation")
+                            future.set_exception(e)
+                    conn.execute("COMMIT")
+            except Exception as e:
+                logger.exception("Group commit of %d mutations failed", len(batch))
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for future, result in done:
+                future.set_result(result)
+            with self._stats_lock:
+                self.batches += 1
+                self.mutations += len(batch)
+                self.max_seen_batch = max(self.max_seen_batch, len(batch))
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "enabled": self.enabled,
+                "batches": self.batches,
+                "mutations": self.mutations,
+                "avg_batch": round(self.mutations / self.batches, 2) if self.batches else None,
+                "max_batch_seen": self.max_seen_batch,
+                "queued": self._queue.qsize(),
+            }
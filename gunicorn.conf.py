@@ -0,0 +1,37 @@
+import os
+
+# ============================================================
+# 🦄 gunicorn settings (picked up automatically: gunicorn app:app)
+# ------------------------------------------------------------
+# Default: gthread workers, GUNICORN_THREADS threads each. The background
+# threads (restore, group-commit writers, callback queue, Dropbox sync,
+# notifier, retention, deposit watcher) are real OS threads. A
+# long-poll/SSE waiter in deposit_events holds one request thread while
+# it waits, so deposit_events caps waiters at half of GUNICORN_THREADS
+# per process by default, leaving the rest for ordinary requests.
+#
+# Opt-in: GUNICORN_WORKER_CLASS=gevent (pip install gevent). Each request
+# is a greenlet, so an idle waiter costs a greenlet instead of a thread
+# and DEPOSIT_WAITERS_MAX can be raised towards worker_connections. The
+# trade-offs: gevent monkey-patches threading before the app is
+# imported, so every background thread above becomes a greenlet in the
+# same hub, and SQLite calls (including busy waits on the write lock,
+# SQLITE_BUSY_TIMEOUT_MS), Dropbox transfers and gzip work do not yield -
+# while one runs, every other request of that worker stalls.
+#
+# PORT                         - listen port
+# WEB_CONCURRENCY              - worker processes
+# GUNICORN_WORKER_CLASS        - gthread (default), sync or gevent
+# GUNICORN_THREADS             - threads per worker when using gthread
+# GUNICORN_WORKER_CONNECTIONS  - concurrent requests per gevent worker
+# GUNICORN_TIMEOUT             - seconds before a silent worker is restarted
+# ============================================================
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1200"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 30
+keepalive = 5
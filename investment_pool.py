@@ -0,0 +1,235 @@
+import os
+import time
+import bisect
+import logging
+import sqlite3
+import threading
+
+import storage
+
+# ============================================================
+# 🏦 Available-investment pool
+# ------------------------------------------------------------
+# Loans are matched to investments that are still available. The pool
+# is the set of investment rows matching a fixed predicate (for eStack:
+# kind='investment' AND status IN ('AVAILABLE','COMPLETED')); a partial
+# index on exactly that predicate (see migrations.py) holds only those
+# rows and everything the mirror needs, so SQLite maintains the pool in
+# the same transaction as every status change - callbacks, repayments
+# and Dropbox restores included.
+#
+# Each process keeps an in-memory mirror so picking a candidate is a
+# tree descent, not a query. A sync lays the pool out twice, by age (id)
+# and by amount, each with a max-amount segment tree on top (O(n log n)
+# per sync); taking or removing a candidate clears its two leaves, and
+# every lookup is O(log n):
+#   fifo      - oldest available investment that covers the amount
+#               (leftmost leaf by age with amount >= x)
+#   best_fit  - smallest available investment that covers the amount
+#               (first leaf by amount at or after the bisect for x)
+# A candidate is taken out of the mirror before it is claimed, and the
+# claim itself is a compare-and-set:
+#   UPDATE ... SET status=? WHERE id=? AND <pool predicate>
+# so two requests - in this or any other worker - can never claim the
+# same investment; the loser just moves on to the next candidate. The
+# mirror re-reads the pool from the partial index when another
+# connection has committed (PRAGMA data_version), at most every
+# POOL_SYNC_INTERVAL_MS, and whenever it runs out of candidates.
+#
+# POOL_SYNC_INTERVAL_MS   - minimum time between mirror refreshes
+# ============================================================
+
+SYNC_INTERVAL = float(os.getenv("POOL_SYNC_INTERVAL_MS", "1000")) / 1000
+MAX_ATTEMPTS = 8            # candidates tried per claim before re-reading the pool
+
+FIFO = "fifo"
+BEST_FIT = "best_fit"
+STRATEGIES = (FIFO, BEST_FIT)
+
+logger = logging.getLogger(__name__)
+
+
+class _MaxTree:
+    """Segment tree of max values over fixed positions; a cleared position holds -inf."""
+
+    def __init__(self, values):
+        self._size = 1
+        while self._size < len(values):
+            self._size *= 2
+        self._tree = [float("-inf")] * (2 * self._size)
+        self._tree[self._size:self._size + len(values)] = values
+        for node in range(self._size - 1, 0, -1):
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+
+    def clear(self, i):
+        node = self._size + i
+        self._tree[node] = float("-inf")
+        node //= 2
+        while node:
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+            node //= 2
+
+    def first_at_least(self, x, start=0):
+        """Lowest position >= start whose value is >= x, or None. O(log n)."""
+        return self._find(1, 0, self._size, x, start)
+
+    def _find(self, node, lo, hi, x, start):
+        if hi <= start or self._tree[node] < x:
+            return None
+        if hi - lo == 1:
+            return lo
+        mid = (lo + hi) // 2
+        found = self._find(2 * node, lo, mid, x, start)
+        return found if found is not None else self._find(2 * node + 1, mid, hi, x, start)
+
+
+class InvestmentPool:
+    """Mirror of one table's available investments with compare-and-set claims."""
+
+    def __init__(self, db_path, table, key, predicate):
+        self.db_path = db_path
+        self.table = table
+        self.key = key                  # column clients know the investment by
+        self.predicate = predicate      # must match the partial index's WHERE clause
+        self._lock = threading.Lock()
+        self._by_amount = []            # sorted (amount, id), fixed between syncs
+        self._by_age = []               # sorted id, fixed between syncs
+        self._amount_tree = _MaxTree([])    # amounts in _by_amount order
+        self._age_tree = _MaxTree([])       # amounts in _by_age order
+        self._entries = {}              # id -> (key, amount, age position, amount position)
+        self._conn = storage.SharedConnection(db_path, readonly=True)  # closed by storage.invalidate()
+        self._data_version = None       # (connection opens, PRAGMA data_version) of the last sync
+        self._generation = None
+        self._synced_at = None
+        self.syncs = 0
+        self.claims = 0
+        self.conflicts = 0
+        self.misses = 0
+
+    # -------------------------
+    # Mirror
+    # -------------------------
+    def _load(self, rows):
+        """Replace the mirror with rows [(id, key, amount)] (called with the lock held)."""
+        amounts = {row_id: float(amount or 0) for row_id, _, amount in rows}
+        self._by_age = sorted(amounts)
+        self._by_amount = sorted((amount, row_id) for row_id, amount in amounts.items())
+        self._age_tree = _MaxTree([amounts[row_id] for row_id in self._by_age])
+        self._amount_tree = _MaxTree([amount for amount, _ in self._by_amount])
+        age_pos = {row_id: i for i, row_id in enumerate(self._by_age)}
+        self._entries = {row_id: (key, amounts[row_id], age_pos[row_id], None) for row_id, key, _ in rows}
+        for i, (_, row_id) in enumerate(self._by_amount):
+            self._entries[row_id] = self._entries[row_id][:3] + (i,)
+
+    def _remove(self, row_id):
+        entry = self._entries.pop(row_id, None)
+        if entry is None:
+            return
+        self._age_tree.clear(entry[2])
+        self._amount_tree.clear(entry[3])
+
+    def sync(self, force=False):
+        """Re-read the pool from the partial index if it changed (or unconditionally with force)."""
+        with self._lock:
+            generation = storage.generation(self.db_path)
+            if (not force and self._synced_at is not None and generation == self._generation
+                    and time.monotonic() - self._synced_at < SYNC_INTERVAL):
+                return
+            self._generation = generation
+            try:
+                with self._conn.use() as conn:
+                    # A reopened connection (first use, after a restore) always re-reads
+                    version = (self._conn.opens, conn.execute("PRAGMA data_version").fetchone()[0])
+                    if version == self._data_version and not force:
+                        self._synced_at = time.monotonic()
+                        return
+                    rows = conn.execute(
+                        f"SELECT id, {self.key}, amount FROM {self.table} WHERE {self.predicate}"
+                    ).fetchall()
+            except sqlite3.Error:
+                logger.exception("Could not read the investment pool from %s", os.path.basename(self.db_path))
+                self._data_version = None
+                return
+            self._data_version = version
+            self._load(rows)
+            self._synced_at = time.monotonic()
+            self.syncs += 1
+
+    def _take(self, amount, strategy):
+        """Remove and return the best candidate (id, key, amount), or None."""
+        with self._lock:
+            if strategy == BEST_FIT:
+                start = bisect.bisect_left(self._by_amount, (amount, float("-inf")))
+                i = self._amount_tree.first_at_least(amount, start)
+                row_id = self._by_amount[i][1] if i is not None else None
+            else:
+                i = self._age_tree.first_at_least(amount)
+                row_id = self._by_age[i] if i is not None else None
+            if row_id is None:
+                return None
+            candidate = (row_id, *self._entries[row_id][:2])
+            self._remove(row_id)
+            return candidate
+
+    # -------------------------
+    # Claims
+    # -------------------------
+    def _cas(self, conn, status, column, value, from_status=None):
+        sql = f"UPDATE {self.table} SET status = ? WHERE {column} = ? AND {self.predicate}"
+        params = [status, value]
+        if from_status is not None:
+            sql += " AND status = ?"
+            params.append(from_status)
+        return conn.execute(sql, params).rowcount > 0
+
+    def claim(self, conn, status, amount=None, strategy=FIFO, investment_id=None, from_status=None):
+        """
+        Move one available investment to status inside conn's current transaction.
+        investment_id claims that investment - only if it is in from_status, when
+        given; otherwise one is picked by strategy among those of at least amount.
+        Returns {"id", "investment_id", "amount"}, or None if nothing (or not that
+        investment) is available.
+        The caller commits; a rolled-back claim reappears at the next sync.
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"strategy must be one of {', '.join(STRATEGIES)}")
+
+        if investment_id is not None:
+            if not self._cas(conn, status, self.key, investment_id, from_status):
+                self.misses += 1
+                return None
+            row = conn.execute(
+                f"SELECT id, amount FROM {self.table} WHERE {self.key} = ? AND status = ?", (investment_id, status)
+            ).fetchone()
+            with self._lock:
+                self._remove(row[0])
+            self.claims += 1
+            return {"id": row[0], "investment_id": investment_id, "amount": row[1]}
+
+        amount = float(amount or 0)
+        self.sync()
+        for attempt in range(2):
+            for _ in range(MAX_ATTEMPTS):
+                candidate = self._take(amount, strategy)
+                if candidate is None:
+                    break
+                row_id, key, value = candidate
+                if self._cas(conn, status, "id", row_id):
+                    self.claims += 1
+                    return {"id": row_id, "investment_id": key, "amount": value}
+                self.conflicts += 1     # claimed by another worker since the last sync
+            if attempt == 0:
+                self.sync(force=True)
+        self.misses += 1
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "available": len(self._entries),
+                "syncs": self.syncs,
+                "claims": self.claims,
+                "conflicts": self.conflicts,
+                "misses": self.misses,
+                "sync_interval_ms": SYNC_INTERVAL * 1000,
+            }
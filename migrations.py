@@ -0,0 +1,345 @@
+import logging
+
+# ============================================================
+# 🧱 Schema migrations
+# ------------------------------------------------------------
+# Each database carries its schema version in PRAGMA user_version.
+# migrate() applies every registered migration above that version, in
+# order, each in its own BEGIN IMMEDIATE transaction together with the
+# user_version bump, so a migration runs exactly once per database even
+# with several workers booting at the same time. Request handlers do no
+# schema work; add a new (version, description, fn) entry instead of
+# touching CREATE/ALTER statements elsewhere.
+#
+# Version 1 of each database is a baseline that also brings databases
+# created by the older ad-hoc CREATE/ALTER code up to the same shape,
+# which is why it (and only it) checks for existing columns.
+# ============================================================
+
+logger = logging.getLogger(__name__)
+
+# Structured columns parsed out of name_of_transaction so lookups can use
+# equality on an index instead of LIKE '%id%' scans.
+ESTACK_COLUMNS = {
+    "deposit_id": "TEXT",
+    "user_id": "TEXT",
+    "kind": "TEXT",
+    "amount": "REAL",
+    "currency": "TEXT",
+    "borrower_phone": "TEXT",
+    "investment_id": "TEXT",
+}
+
+# Rows that can still be lent out. The investment pools claim with exactly
+# these predicates so SQLite can use the partial indexes built on them.
+ESTACK_POOL_PREDICATE = "kind = 'investment' AND status IN ('AVAILABLE', 'COMPLETED')"
+TRANSACTIONS_POOL_PREDICATE = "type = 'investment' AND status = 'ACTIVE'"
+
+
+def add_missing_columns(conn, table, columns):
+    existing = {r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    for col, coltype in columns.items():
+        if col not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {coltype}")
+            logger.info("Added column %s to %s table", col, table)
+
+
+def create_indexes(conn, indexes):
+    for index_name, (table, cols) in indexes.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({cols})")
+
+
+def create_pool_index(conn, table, key, predicate):
+    # Holds only the available rows, ordered by amount then age (rowid), and
+    # covers the pool's reload query (id, key, amount)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_pool ON {table} (amount, {key}) WHERE {predicate}")
+
+
+# -------------------------
+# transactions.db
+# -------------------------
+def _sc_baseline(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS wallets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            balance REAL DEFAULT 0,
+            currency TEXT DEFAULT 'ZMW',
+            updated_at TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            message TEXT,
+            created_at TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            depositId TEXT UNIQUE,
+            status TEXT,
+            amount REAL,
+            currency TEXT,
+            phoneNumber TEXT,
+            provider TEXT,
+            providerTransactionId TEXT,
+            failureCode TEXT,
+            failureMessage TEXT,
+            metadata TEXT,
+            received_at TEXT,
+            updated_at TEXT,
+            created_at TEXT,
+            type TEXT DEFAULT 'payment',
+            user_id TEXT,
+            investment_id TEXT,
+            reference TEXT
+        )
+    """)
+    add_missing_columns(conn, "transactions", {
+        "reference": "TEXT",
+        "phoneNumber": "TEXT",
+        "metadata": "TEXT",
+        "updated_at": "TEXT",
+        "created_at": "TEXT",
+        "type": "TEXT DEFAULT 'payment'",
+        "user_id": "TEXT",
+        "investment_id": "TEXT",
+    })
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS loans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            loanId TEXT UNIQUE,
+            user_id TEXT,
+            phone TEXT,                -- borrower's phone number for payouts
+            investment_id TEXT,        -- links this loan to an investment
+            amount REAL,
+            interest REAL,
+            status TEXT,               -- PENDING, APPROVED, DISAPPROVED, PAID
+            expected_return_date TEXT,
+            created_at TEXT,
+            metadata TEXT,
+            approved_by TEXT,
+            approved_at TEXT,
+            updated_at TEXT,
+            disbursed_at TEXT
+        )
+    """)
+    add_missing_columns(conn, "loans", {
+        "loanId": "TEXT",
+        "user_id": "TEXT",
+        "investment_id": "TEXT",
+        "amount": "REAL",
+        "interest": "REAL",
+        "status": "TEXT",
+        "expected_return_date": "TEXT",
+        "created_at": "TEXT",
+        "phone": "TEXT",
+        "metadata": "TEXT",
+        "approved_by": "TEXT",
+        "approved_at": "TEXT",
+        "updated_at": "TEXT",
+        "disbursed_at": "TEXT",
+    })
+
+
+def _sc_metadata_columns(conn):
+    # Filled from metadata at write time (and by the startup backfill for older rows)
+    add_missing_columns(conn, "transactions", {
+        "loan_id": "TEXT",      # metadata.loanId
+        "purpose": "TEXT",      # metadata.purpose (lower-cased)
+    })
+
+
+def _sc_indexes(conn):
+    # Each index implicitly ends in id, so keyset pages ("... AND id < ?") are range scans
+    create_indexes(conn, {
+        "idx_transactions_user_id": ("transactions", "user_id"),
+        "idx_transactions_loan_id": ("transactions", "loan_id"),
+        "idx_transactions_purpose": ("transactions", "purpose"),
+        "idx_loans_status": ("loans", "status"),
+        "idx_loans_user_id": ("loans", "user_id"),
+        "idx_notifications_user_id": ("notifications", "user_id"),
+    })
+
+
+def _sc_bookkeeping(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_state (
+            name TEXT PRIMARY KEY,
+            last_rowid INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS processed_callbacks (
+            callback_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            source TEXT,
+            processed_at REAL,
+            PRIMARY KEY (callback_id, status)
+        )
+    """)
+
+
+def _sc_notification_feed(conn):
+    # The feed is read by (user_id, id); idx_notifications_user_id already is
+    # (user_id, rowid) and ids follow created_at (one writer appends them), so
+    # both pages and since=<id> deltas are range scans without another index.
+    add_missing_columns(conn, "notifications", {"read_at": "TEXT"})
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS notification_counters (
+            user_id TEXT PRIMARY KEY,
+            unread INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        INSERT OR REPLACE INTO notification_counters (user_id, unread)
+        SELECT user_id, COUNT(*) FROM notifications
+        WHERE read_at IS NULL AND user_id IS NOT NULL
+        GROUP BY user_id
+    """)
+    # Retention only ever deletes read rows
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_notifications_read_at ON notifications (read_at) "
+        "WHERE read_at IS NOT NULL"
+    )
+
+
+def _sc_wallet_ledger(conn):
+    # One wallet per user, so balances can be upserted with balance = balance + ?.
+    # Older code could create duplicates; fold them into the oldest row first.
+    for user_id, keep_id, total in conn.execute("""
+        SELECT user_id, MIN(id), SUM(COALESCE(balance, 0)) FROM wallets
+        GROUP BY user_id HAVING COUNT(*) > 1
+    """).fetchall():
+        conn.execute("UPDATE wallets SET balance = ? WHERE id = ?", (total, keep_id))
+        conn.execute("DELETE FROM wallets WHERE user_id IS ? AND id != ?", (user_id, keep_id))
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_wallets_user_id ON wallets (user_id)")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS wallet_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            amount REAL NOT NULL,       -- signed: credits > 0, debits < 0
+            kind TEXT NOT NULL,         -- e.g. opening_balance, loan_disbursement
+            reference TEXT,             -- loanId / depositId the entry belongs to
+            balance_after REAL,
+            created_at TEXT
+        )
+    """)
+    create_indexes(conn, {
+        "idx_wallet_ledger_user_id": ("wallet_ledger", "user_id"),
+        "idx_wallet_ledger_reference": ("wallet_ledger", "reference"),
+    })
+    for op in ("UPDATE", "DELETE"):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS wallet_ledger_no_{op.lower()}
+            BEFORE {op} ON wallet_ledger
+            BEGIN SELECT RAISE(ABORT, 'wallet_ledger is append-only'); END
+        """)
+    # Existing balances become each wallet's first entry so the ledger sums match
+    conn.execute("""
+        INSERT INTO wallet_ledger (user_id, amount, kind, balance_after, created_at)
+        SELECT user_id, balance, 'opening_balance', balance, datetime('now')
+        FROM wallets WHERE user_id IS NOT NULL AND COALESCE(balance, 0) != 0
+    """)
+
+
+def _sc_investment_pool(conn):
+    create_pool_index(conn, "transactions", "reference", TRANSACTIONS_POOL_PREDICATE)
+
+
+TRANSACTIONS_MIGRATIONS = [
+    (1, "baseline wallets/notifications/transactions/loans", _sc_baseline),
+    (2, "transactions.loan_id/purpose from metadata", _sc_metadata_columns),
+    (3, "lookup and pagination indexes", _sc_indexes),
+    (4, "backfill_state and processed_callbacks", _sc_bookkeeping),
+    (5, "notifications.read_at, unread counters, retention index", _sc_notification_feed),
+    (6, "append-only wallet_ledger, one wallet per user", _sc_wallet_ledger),
+    (7, "available-investment pool index", _sc_investment_pool),
+]
+
+
+# -------------------------
+# estack.db
+# -------------------------
+def _estack_baseline(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS estack_transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name_of_transaction TEXT NOT NULL,  -- e.g. "K1000 | user_123 | DEP4567"
+            status TEXT NOT NULL,               -- e.g. "invested", "loaned_out", "repaid"
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            deposit_id TEXT,
+            user_id TEXT,
+            kind TEXT,                          -- "investment" or "loan"
+            amount REAL,
+            currency TEXT,
+            borrower_phone TEXT,
+            investment_id TEXT                  -- loans only: the funding investment's deposit_id
+        )
+    """)
+    add_missing_columns(conn, "estack_transactions", ESTACK_COLUMNS)
+
+
+def _estack_indexes(conn):
+    create_indexes(conn, {
+        "idx_estack_deposit_id": ("estack_transactions", "deposit_id"),
+        "idx_estack_user_id": ("estack_transactions", "user_id"),
+        "idx_estack_borrower_phone": ("estack_transactions", "borrower_phone"),
+        "idx_estack_investment_id": ("estack_transactions", "investment_id"),
+        "idx_estack_kind_status": ("estack_transactions", "kind, status"),
+    })
+
+
+def _estack_investment_pool(conn):
+    create_pool_index(conn, "estack_transactions", "deposit_id", ESTACK_POOL_PREDICATE)
+
+
+ESTACK_MIGRATIONS = [
+    (1, "baseline estack_transactions with structured columns", _estack_baseline),
+    (2, "lookup indexes", _estack_indexes),
+    (3, "available-investment pool index", _estack_investment_pool),
+]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, migrations, name):
+    """Apply every migration above the database's user_version. Returns the resulting version."""
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None     # explicit BEGIN/COMMIT around DDL
+    try:
+        for version, description, apply in migrations:
+            if schema_version(conn) >= version:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Re-check under the write lock: another worker may have just applied it
+                if schema_version(conn) >= version:
+                    conn.execute("ROLLBACK")
+                    continue
+                apply(conn)
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            logger.info("Migrated %s to version %d: %s", name, version, description)
+        return schema_version(conn)
+    finally:
+        conn.isolation_level = isolation_level
+
+
+def migrate_transactions(conn):
+    return migrate(conn, TRANSACTIONS_MIGRATIONS, "transactions.db")
+
+
+def migrate_estack(conn):
+    return migrate(conn, ESTACK_MIGRATIONS, "estack.db")
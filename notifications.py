@@ -0,0 +1,253 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+# ============================================================
+# 📢 Notification pipeline
+# ------------------------------------------------------------
+# notify() only appends to an in-process queue, so request handlers pay
+# microseconds for a notification. A background thread drains the queue
+# in batches, inserts each batch into the notifications table with one
+# executemany (through the transactions.db group-commit writer, so it
+# shares commits with callback writes instead of competing for the
+# write lock), then hands the batch to the configured delivery channels.
+#
+# Channels are pluggable: register_channel(name, fn) where fn(batch)
+# receives [(user_id, message, created_at), ...]. Built in:
+#   log       - log each notification (the previous behaviour)
+#   sms-sim   - pretend SMS provider: sleeps NOTIFY_SIM_LATENCY_MS per batch
+#   push-sim  - pretend push provider, same
+#
+# The same batch bumps notification_counters.unread per user, and
+# mark_read() decrements it in the transaction that sets read_at, so the
+# badge count is a primary-key lookup. A retention thread deletes read
+# notifications older than NOTIFY_RETENTION_DAYS in small chunks;
+# unread ones are never trimmed, so the counters stay exact.
+#
+# NOTIFY_CHANNELS              - comma-separated channel names (default "log")
+# NOTIFY_MAX_BATCH             - notifications per insert/delivery batch
+# NOTIFY_SIM_LATENCY_MS        - simulated provider round trip
+# NOTIFY_RETENTION_DAYS        - keep read notifications this long (0 = forever)
+# NOTIFY_RETENTION_INTERVAL    - seconds between retention passes
+#
+# The queue is in memory: it is drained at shutdown, but notifications
+# still queued when a worker is killed are lost.
+# ============================================================
+
+CHANNELS = [c.strip() for c in os.getenv("NOTIFY_CHANNELS", "log").split(",") if c.strip()]
+MAX_BATCH = int(os.getenv("NOTIFY_MAX_BATCH", "200"))
+SIM_LATENCY = float(os.getenv("NOTIFY_SIM_LATENCY_MS", "50")) / 1000
+RETENTION_DAYS = float(os.getenv("NOTIFY_RETENTION_DAYS", "90"))
+RETENTION_INTERVAL = float(os.getenv("NOTIFY_RETENTION_INTERVAL", "3600"))
+RETENTION_CHUNK = 500       # rows deleted per write transaction
+
+logger = logging.getLogger(__name__)
+
+_channels = {}
+
+
+def register_channel(name, deliver):
+    """Make a delivery channel available to NOTIFY_CHANNELS / Notifier(channels=...)."""
+    _channels[name] = deliver
+
+
+def _log_channel(batch):
+    for user_id, message, _ in batch:
+        logger.info(f"📢 Notification sent to investor {user_id}: {message}")
+
+
+def _simulated(kind):
+    def deliver(batch):
+        time.sleep(SIM_LATENCY)
+        for user_id, message, _ in batch:
+            logger.info("[%s-sim] → %s: %s", kind, user_id, message)
+    return deliver
+
+
+register_channel("log", _log_channel)
+register_channel("sms-sim", _simulated("sms"))
+register_channel("push-sim", _simulated("push"))
+
+
+def _insert_notifications(conn, batch):
+    conn.executemany(
+        "INSERT INTO notifications (user_id, message, created_at) VALUES (?, ?, ?)", batch
+    )
+    conn.executemany("""
+        INSERT INTO notification_counters (user_id, unread) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET unread = unread + excluded.unread
+    """, Counter(user_id for user_id, _, _ in batch).items())
+
+
+def _mark_read(conn, user_id, up_to, ids):
+    now = datetime.utcnow().isoformat()
+    if ids is not None:
+        marked = 0
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            marked += conn.execute(
+                f"UPDATE notifications SET read_at = ? WHERE user_id = ? AND read_at IS NULL "
+                f"AND id IN ({','.join('?' * len(chunk))})",
+                [now, user_id, *chunk],
+            ).rowcount
+    else:
+        sql = "UPDATE notifications SET read_at = ? WHERE user_id = ? AND read_at IS NULL"
+        params = [now, user_id]
+        if up_to is not None:
+            sql += " AND id <= ?"
+            params.append(up_to)
+        marked = conn.execute(sql, params).rowcount
+    if marked:
+        conn.execute(
+            "UPDATE notification_counters SET unread = MAX(unread - ?, 0) WHERE user_id = ?",
+            (marked, user_id),
+        )
+    return marked, unread_count(conn, user_id)
+
+
+def _trim_read(conn, cutoff):
+    return conn.execute("""
+        DELETE FROM notifications WHERE id IN (
+            SELECT id FROM notifications
+            WHERE read_at IS NOT NULL AND read_at < ?
+            LIMIT ?
+        )
+    """, (cutoff, RETENTION_CHUNK)).rowcount
+
+
+def unread_count(conn, user_id):
+    row = conn.execute("SELECT unread FROM notification_counters WHERE user_id = ?", (str(user_id),)).fetchone()
+    return row[0] if row else 0
+
+
+class Notifier:
+    """Queues notifications and writes/delivers them in batches on a background thread."""
+
+    def __init__(self, writer, channels=CHANNELS, max_batch=MAX_BATCH):
+        self.writer = writer            # GroupCommitWriter for transactions.db
+        self.channels = list(channels)
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.write_errors = 0
+        self.delivery_errors = {}
+        self.trimmed = 0
+        self._retention = None
+        atexit.register(self.flush)
+
+    def notify(self, user_id, message):
+        """Queue a notification; returns immediately."""
+        self._ensure_started()
+        self._queue.put((str(user_id), message, datetime.utcnow().isoformat()))
+        with self._stats_lock:
+            self.queued += 1
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if not (self._thread and self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, name="notifier", daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.writer.run(_insert_notifications, batch)
+                with self._stats_lock:
+                    self.written += len(batch)
+                    self.batches += 1
+            except Exception:
+                logger.exception("❌ Failed to store %d notifications", len(batch))
+                with self._stats_lock:
+                    self.write_errors += len(batch)
+            self._deliver(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _deliver(self, batch):
+        for name in self.channels:
+            deliver = _channels.get(name)
+            try:
+                if deliver is None:
+                    raise KeyError(f"unknown notification channel {name!r}")
+                deliver(batch)
+            except Exception:
+                logger.exception("❌ Notification channel %s failed for %d notifications", name, len(batch))
+                with self._stats_lock:
+                    self.delivery_errors[name] = self.delivery_errors.get(name, 0) + len(batch)
+
+    def mark_read(self, user_id, up_to=None, ids=None):
+        """
+        Mark a user's unread notifications read: those in ids, or every one up to
+        and including id up_to (all of them when both are None).
+        Returns (number marked, unread remaining).
+        """
+        return self.writer.run(_mark_read, str(user_id), up_to, ids)
+
+    # -------------------------
+    # Retention
+    # -------------------------
+    def start_retention(self, days=RETENTION_DAYS, interval=RETENTION_INTERVAL):
+        if days <= 0 or (self._retention and self._retention.is_alive()):
+            return
+        self._retention = threading.Thread(
+            target=self._retain, args=(days, interval), name="notification-retention", daemon=True
+        )
+        self._retention.start()
+
+    def _retain(self, days, interval):
+        while True:
+            cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+            try:
+                while True:
+                    deleted = self.writer.run(_trim_read, cutoff)
+                    with self._stats_lock:
+                        self.trimmed += deleted
+                    if deleted < RETENTION_CHUNK:
+                        break
+            except Exception:
+                logger.exception("❌ Notification retention pass failed")
+            time.sleep(interval)
+
+    def flush(self, timeout=10):
+        """Block until everything queued so far has been written and delivered (or timeout)."""
+        if not (self._thread and self._thread.is_alive()):
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "channels": self.channels,
+                "queued": self.queued,
+                "pending": self._queue.unfinished_tasks,
+                "written": self.written,
+                "batches": self.batches,
+                "avg_batch": round(self.written / self.batches, 2) if self.batches else None,
+                "write_errors": self.write_errors,
+                "delivery_errors": dict(self.delivery_errors),
+                "trimmed": self.trimmed,
+            }
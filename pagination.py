@@ -0,0 +1,92 @@
+import os
+
+from flask import request, jsonify
+
+# ============================================================
+# 📄 Keyset pagination + field selection for list endpoints
+# ------------------------------------------------------------
+# ?limit=N        - page size (default PAGE_SIZE_DEFAULT, capped at PAGE_SIZE_MAX)
+# ?after=<cursor> - next_cursor from the previous page; rows strictly older
+# ?fields=a,b     - only return these keys
+#
+# Cursors are the rowid of the last row served, so each page is one
+# index range scan ("... AND id < ? ORDER BY id DESC LIMIT ?") no matter
+# how deep the client pages. Clients that send neither limit nor after
+# still get a plain JSON list (the first page), with the cursor in the
+# X-Next-Cursor header; paging clients get {"items", "next_cursor"}.
+# ============================================================
+
+DEFAULT_LIMIT = int(os.getenv("PAGE_SIZE_DEFAULT", "50"))
+MAX_LIMIT = int(os.getenv("PAGE_SIZE_MAX", "500"))
+
+_columns = {}
+
+
+class PageError(ValueError):
+    """Bad limit/after/fields parameter; the message is safe to return as a 400."""
+
+
+def page_args(default=DEFAULT_LIMIT):
+    """Return (limit, after) from the query string. after is None on the first page."""
+    try:
+        limit = int(request.args.get("limit", default))
+    except ValueError:
+        raise PageError("limit must be an integer")
+    if limit < 1:
+        raise PageError("limit must be at least 1")
+
+    after = request.args.get("after")
+    if after in (None, ""):
+        return min(limit, MAX_LIMIT), None
+    try:
+        return min(limit, MAX_LIMIT), int(after)
+    except ValueError:
+        raise PageError("after must be a cursor returned as next_cursor")
+
+
+def field_list(allowed):
+    """Requested ?fields= as a list, validated against allowed. None means all fields."""
+    raw = request.args.get("fields")
+    if not raw:
+        return None
+    fields = list(dict.fromkeys(f.strip() for f in raw.split(",") if f.strip()))
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise PageError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def table_columns(db, table):
+    """Column names of a table (cached; schema only changes at startup)."""
+    if table not in _columns:
+        _columns[table] = [r[1] for r in db.execute(f"PRAGMA table_info({table})").fetchall()]
+    return _columns[table]
+
+
+def select_list(fields, key="id"):
+    """SQL column list for a projection; the cursor key is always selected."""
+    if fields is None:
+        return "*"
+    return ", ".join(dict.fromkeys([key] + fields))
+
+
+def project(item, fields):
+    return {k: item[k] for k in fields} if fields else item
+
+
+def split_page(rows, limit, key="id"):
+    """Given up to limit+1 rows, return (page rows, next_cursor)."""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, str(rows[-1][key])
+    return rows, None
+
+
+def page_response(items, next_cursor):
+    if "limit" in request.args or "after" in request.args:
+        resp = jsonify({"items": items, "next_cursor": next_cursor})
+    else:
+        resp = jsonify(items)
+    if next_cursor is not None:
+        resp.headers["X-Next-Cursor"] = next_cursor
+    return resp, 200
@@ -0,0 +1,202 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ============================================================
+# 🔐 PawaPay API client
+# ------------------------------------------------------------
+# One pooled keep-alive requests.Session per worker process, with
+# connect/read timeouts and retry with backoff. All attempts of one call,
+# backoff sleeps included, fit in PAWAPAY_TOTAL_TIMEOUT, which defaults
+# to 3/4 of the gunicorn worker timeout so a retrying call is never
+# killed mid-request. A POST is retried only when it carries an
+# idempotency key (deposits/payouts pass their depositId/payoutId, which
+# PawaPay deduplicates); without one it is retried only if the
+# connection was never established.
+#
+# API_MODE=sandbox|live
+# SANDBOX_API_TOKEN / LIVE_API_TOKEN
+# PAWAPAY_CONNECT_TIMEOUT, PAWAPAY_READ_TIMEOUT (seconds, per attempt)
+# PAWAPAY_TOTAL_TIMEOUT (seconds, all attempts)
+# PAWAPAY_MAX_RETRIES, PAWAPAY_BACKOFF, PAWAPAY_POOL_SIZE
+# ============================================================
+
+API_MODE = os.getenv("API_MODE", "sandbox")
+SANDBOX_API_TOKEN = os.getenv("SANDBOX_API_TOKEN")
+LIVE_API_TOKEN = os.getenv("LIVE_API_TOKEN")
+API_TOKEN = LIVE_API_TOKEN if API_MODE == "live" else SANDBOX_API_TOKEN
+
+PAWAPAY_URL = (
+    "https://api.pawapay.io/deposits"
+    if API_MODE == "live"
+    else "https://api.sandbox.pawapay.io/deposits"
+)
+
+PAWAPAY_PAYOUT_URL = (
+    "https://api.pawapay.io/v2/payouts"
+    if API_MODE == "live"
+    else "https://api.sandbox.pawapay.io/v2/payouts"
+)
+
+CONNECT_TIMEOUT = float(os.getenv("PAWAPAY_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(os.getenv("PAWAPAY_READ_TIMEOUT", "20"))
+MAX_RETRIES = int(os.getenv("PAWAPAY_MAX_RETRIES", "3"))
+BACKOFF = float(os.getenv("PAWAPAY_BACKOFF", "0.5"))
+POOL_SIZE = int(os.getenv("PAWAPAY_POOL_SIZE", "10"))
+WORKER_TIMEOUT = float(os.getenv("GUNICORN_TIMEOUT", "60"))     # see gunicorn.conf.py
+TOTAL_TIMEOUT = float(os.getenv("PAWAPAY_TOTAL_TIMEOUT", str(WORKER_TIMEOUT * 0.75)))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MIN_ATTEMPT = 1.0          # seconds of budget a retry must still have after its backoff
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Return this process's pooled Session, creating it on first use.
+    Keyed by pid so gunicorn workers forked after import never share sockets.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+    with _session_lock:
+        if _session is None or _session_pid != pid:
+            # Retries are done by request() so they can share one time budget
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE, max_retries=0)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({
+                "Authorization": f"Bearer {API_TOKEN}",
+                "Content-Type": "application/json",
+            })
+            _session, _session_pid = session, pid
+    return _session
+
+
+class LatencyMetrics:
+    """Per-operation call counts, errors and latency percentiles over a sliding window."""
+
+    def __init__(self, window=500):
+        self.window = window
+        self._lock = threading.Lock()
+        self._ops = {}
+
+    def record(self, op, elapsed_ms, status_code=None, error=None):
+        with self._lock:
+            stats = self._ops.setdefault(op, {
+                "calls": 0,
+                "errors": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "last_status": None,
+                "samples": deque(maxlen=self.window),
+            })
+            stats["calls"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            stats["samples"].append(elapsed_ms)
+            stats["last_status"] = status_code
+            if error is not None or (status_code is not None and status_code >= 400):
+                stats["errors"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for op, stats in self._ops.items():
+                samples = sorted(stats["samples"])
+
+                def pct(p):
+                    return round(samples[min(len(samples) - 1, int(len(samples) * p))], 2) if samples else None
+
+                result[op] = {
+                    "calls": stats["calls"],
+                    "errors": stats["errors"],
+                    "avg_ms": round(stats["total_ms"] / stats["calls"], 2),
+                    "p50_ms": pct(0.50),
+                    "p95_ms": pct(0.95),
+                    "max_ms": round(stats["max_ms"], 2),
+                    "last_status": stats["last_status"],
+                }
+            return result
+
+
+metrics = LatencyMetrics()
+
+
+def _backoff(attempt, resp):
+    """Seconds to wait before retry number attempt + 1 (Retry-After wins if longer)."""
+    delay = BACKOFF * (2 ** attempt)
+    if resp is not None:
+        try:
+            delay = max(delay, float(resp.headers.get("Retry-After", 0)))
+        except ValueError:
+            pass
+    return delay
+
+
+def request(op, method, url, idempotency_key=None, **kwargs):
+    """
+    Send a request through the pooled session, with timeouts, retries and
+    latency recording. Connection errors and RETRY_STATUSES are retried up to
+    MAX_RETRIES times while TOTAL_TIMEOUT allows; non-idempotent methods only
+    with an idempotency_key, or when the connection could not be opened.
+    Returns the last Response, or raises the last RequestException.
+    """
+    connect_timeout, read_timeout = kwargs.pop("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    replayable = method.upper() in IDEMPOTENT_METHODS or idempotency_key is not None
+    started = time.perf_counter()
+    deadline = time.monotonic() + TOTAL_TIMEOUT
+    attempt = 0
+    while True:
+        remaining = max(deadline - time.monotonic(), 0.001)
+        resp = error = None
+        try:
+            resp = get_session().request(
+                method, url, timeout=(min(connect_timeout, remaining), min(read_timeout, remaining)), **kwargs
+            )
+        except requests.RequestException as e:
+            error = e
+        if error is not None:
+            retryable = replayable or isinstance(error, requests.ConnectTimeout)
+        else:
+            retryable = replayable and resp.status_code in RETRY_STATUSES
+        delay = _backoff(attempt, resp)
+        if not retryable or attempt >= MAX_RETRIES or deadline - time.monotonic() - delay < MIN_ATTEMPT:
+            break
+        logger.warning("PawaPay %s attempt %d failed (%s), retrying in %.1fs",
+                       op, attempt + 1, error or resp.status_code, delay)
+        if resp is not None:
+            resp.close()
+        time.sleep(delay)
+        attempt += 1
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if error is not None:
+        metrics.record(op, elapsed_ms, error=error)
+        logger.error("PawaPay %s failed after %d attempts: %s", op, attempt + 1, error)
+        raise error
+    metrics.record(op, elapsed_ms, status_code=resp.status_code)
+    return resp
+
+
+def initiate_deposit(payload):
+    """POST a deposit request to PawaPay (retried on its depositId). Returns the raw Response."""
+    return request("deposit", "POST", PAWAPAY_URL, idempotency_key=payload.get("depositId"), json=payload)
+
+
+def initiate_payout(payload):
+    """POST a payout request to PawaPay (retried on its payoutId). Returns the raw Response."""
+    return request("payout", "POST", PAWAPAY_PAYOUT_URL, idempotency_key=payload.get("payoutId"), json=payload)
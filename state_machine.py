@@ -0,0 +1,114 @@
+import threading
+
+# ============================================================
+# 🔀 Status transitions
+# ------------------------------------------------------------
+# Every loan/investment status change is one compare-and-set UPDATE:
+#
+#   UPDATE <table> SET status = <target>, ...
+#   WHERE <key> = ? AND UPPER(status) IN (<statuses allowed to reach target>)
+#
+# and its row count decides whether the transition happened. There is
+# no SELECT-check-UPDATE window, so two workers acting on the same loan
+# cannot both succeed; the loser gets 0 rows and reports the conflict.
+# The allowed transitions live in the tables below, not in handlers.
+# Statuses are compared case-insensitively (older rows have e.g.
+# "disbursed" and "DISBURSED").
+#
+# Counts of applied and rejected transitions per target are served by
+# /debug/transitions.
+# ============================================================
+
+
+class StateMachine:
+    """Allowed status transitions for one kind of row, applied with compare-and-set."""
+
+    def __init__(self, name, table, key, transitions, scope=None):
+        self.name = name
+        self.table = table
+        self.key = key
+        self.scope = scope          # extra predicate, e.g. "kind = 'loan'"
+        # target -> statuses it may be reached from
+        self.transitions = {target: {s.upper() for s in sources} for target, sources in transitions.items()}
+        self._lock = threading.Lock()
+        self.applied = {}
+        self.rejected = {}
+
+    def sources(self, target):
+        return sorted(self.transitions[target])
+
+    def apply(self, conn, target, where, params=(), **columns):
+        """
+        Move every row matching where (and scope) whose status may reach target.
+        columns are set in the same UPDATE. Returns the number of rows moved.
+        """
+        allowed = self.sources(target)
+        assignments = ", ".join(["status = ?"] + [f"{col} = ?" for col in columns])
+        sql = (
+            f"UPDATE {self.table} SET {assignments} WHERE ({where})"
+            + (f" AND {self.scope}" if self.scope else "")
+            + f" AND UPPER(COALESCE(status, '')) IN ({','.join('?' * len(allowed))})"
+        )
+        moved = conn.execute(sql, [target, *columns.values(), *params, *allowed]).rowcount
+        self.record(target, moved)
+        return moved
+
+    def record(self, target, moved):
+        """Count a transition applied elsewhere (e.g. an investment_pool claim); moved=0 is a rejection."""
+        with self._lock:
+            counts = self.applied if moved else self.rejected
+            counts[target] = counts.get(target, 0) + (moved or 1)
+
+    def transition(self, conn, key, target, **columns):
+        """Move one row (by key) to target. True if it was in an allowed status."""
+        return self.apply(conn, target, f"{self.key} = ?", (key,), **columns) > 0
+
+    def current(self, conn, key):
+        """The row's status, or None if there is no such row (for reporting a rejected transition)."""
+        sql = f"SELECT status FROM {self.table} WHERE {self.key} = ?" + (f" AND {self.scope}" if self.scope else "")
+        row = conn.execute(sql, (key,)).fetchone()
+        return row[0] if row else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "transitions": {t: self.sources(t) for t in self.transitions},
+                "applied": dict(self.applied),
+                "rejected": dict(self.rejected),
+            }
+
+
+# transactions.db loans (StudyCraft)
+loan_states = StateMachine("loan", "loans", "loanId", {
+    "APPROVED": {"PENDING"},
+    "REJECTED": {"PENDING"},
+    "DISAPPROVED": {"PENDING"},
+    "disbursed": {"APPROVED"},
+    "PAID": {"DISBURSED"},
+})
+
+# estack.db investments; AVAILABLE/COMPLETED ones are also claimed through investment_pool
+investment_states = StateMachine("investment", "estack_transactions", "deposit_id", {
+    "REQUESTED": {"AVAILABLE", "COMPLETED"},
+    "IN_USE": {"AVAILABLE", "COMPLETED", "REQUESTED"},
+    "REPAID": {"IN_USE", "REQUESTED"},
+    "AVAILABLE": {"IN_USE", "REQUESTED", "REPAID"},
+}, scope="kind = 'investment'")
+
+# estack.db loans
+estack_loan_states = StateMachine("estack_loan", "estack_transactions", "deposit_id", {
+    "REPAID": {"ACTIVE"},
+}, scope="kind = 'loan'")
+
+# transactions.db investments: COMPLETED once the deposit callback settles it;
+# ACTIVE ones are also claimed through transactions_pool
+transactions_investment_states = StateMachine("transactions_investment", "transactions", "depositId", {
+    "LOANED_OUT": {"ACTIVE", "COMPLETED"},
+    "DISBURSED": {"LOANED_OUT"},
+}, scope="type = 'investment'")
+
+machines = (loan_states, investment_states, estack_loan_states, transactions_investment_states)
+
+
+def stats():
+    return {m.name: m.stats() for m in machines}
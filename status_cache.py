@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+# ============================================================
+# ⚡ Deposit status cache
+# ------------------------------------------------------------
+# Client apps poll /deposit_status, /transactions and
+# /api/investments/status while a deposit settles. Those lookups are
+# answered from this in-process LRU when possible:
+#
+# - the callback handler writes the new row/status through to the cache
+#   right after its commit, so a poll after the callback never needs
+#   the database;
+# - a miss reads the database once and caches the result with fill(),
+#   which drops it if a write-through or invalidation for that key
+#   happened after the reader took its version() - so a slow reader can
+#   never overwrite a newer status with the row it read before the
+#   callback committed;
+# - other writers (loan flows, initiations) invalidate what they touch.
+#
+# Every gunicorn worker has its own cache and only the worker that
+# handled a write sees it immediately, so entries also expire: in-flight
+# statuses (ACCEPTED, PENDING, ...) after STATUS_CACHE_PENDING_TTL,
+# everything else after STATUS_CACHE_TTL. That TTL is how long another
+# worker may keep answering with a superseded status (a settled one that
+# was later reversed, or a row a loan flow invalidated elsewhere), so it
+# stays a few seconds: enough to absorb a polling burst, short enough to
+# be no worse than a client's own poll interval.
+#
+# STATUS_CACHE_SIZE          - max entries (all namespaces)
+# STATUS_CACHE_TTL           - seconds, settled statuses
+# STATUS_CACHE_PENDING_TTL   - seconds, in-flight statuses
+# ============================================================
+
+CAPACITY = int(os.getenv("STATUS_CACHE_SIZE", "10000"))
+TTL = float(os.getenv("STATUS_CACHE_TTL", "5"))
+PENDING_TTL = float(os.getenv("STATUS_CACHE_PENDING_TTL", "2"))
+
+STRIPES = 1024              # write-version slots keys hash into
+
+PENDING_STATUSES = {"ACCEPTED", "PENDING", "SUBMITTED", "ENQUEUED", "PROCESSING", "IN_RECONCILIATION"}
+
+
+class StatusCache:
+    """Bounded LRU of (namespace, id) -> response value with per-entry expiry."""
+
+    def __init__(self, capacity=CAPACITY, ttl=TTL, pending_ttl=PENDING_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self._entries = OrderedDict()   # key -> (value, expires_at, size)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._seq = 0
+        self._versions = [0] * STRIPES  # last write sequence per key stripe
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.writes = 0
+        self.stale_fills = 0
+
+    def get(self, namespace, key):
+        """The cached value, or None on a miss (absent or expired)."""
+        k = (namespace, str(key))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(k)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] <= now:
+                self._drop(k)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(k)
+            self.hits += 1
+            return entry[0]
+
+    def version(self, namespace, key):
+        """Token for fill(); take it after a miss and before reading the database."""
+        with self._lock:
+            return self._versions[hash((namespace, str(key))) % STRIPES]
+
+    def put(self, namespace, key, value, status=None):
+        """Write-through after a commit: cache value; status (defaults to value["status"]) picks the TTL."""
+        k = (namespace, str(key))
+        with self._lock:
+            self._bump(k)
+            self._store(k, value, status)
+
+    def fill(self, namespace, key, value, version, status=None):
+        """
+        Cache value read from the database after a miss, unless key was written
+        through or invalidated since version() returned version. True if stored.
+        """
+        k = (namespace, str(key))
+        with self._lock:
+            if self._versions[hash(k) % STRIPES] != version:
+                self.stale_fills += 1
+                return False
+            self._store(k, value, status)
+            return True
+
+    def _store(self, k, value, status):
+        if status is None and isinstance(value, dict):
+            status = value.get("status")
+        ttl = self.pending_ttl if str(status or "").upper() in PENDING_STATUSES else self.ttl
+        size = len(json.dumps(value, default=str)) + len(k[1])
+        if k in self._entries:
+            self._drop(k)
+        self._entries[k] = (value, time.monotonic() + ttl, size)
+        self._bytes += size
+        self.writes += 1
+        while len(self._entries) > self.capacity:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _bump(self, k):
+        self._seq += 1
+        self._versions[hash(k) % STRIPES] = self._seq
+
+    def invalidate(self, namespace, key=None):
+        """Forget one entry, or the whole namespace when key is None."""
+        with self._lock:
+            if key is not None:
+                k = (namespace, str(key))
+                self._bump(k)
+                self._drop(k)
+                return
+            self._seq += 1
+            self._versions = [self._seq] * STRIPES
+            for k in [k for k in self._entries if k[0] == namespace]:
+                self._drop(k)
+
+    def _drop(self, k):
+        entry = self._entries.pop(k, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "capacity": self.capacity,
+                "approx_bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "writes": self.writes,
+                "stale_fills": self.stale_fills,
+                "ttl_seconds": self.ttl,
+                "pending_ttl_seconds": self.pending_ttl,
+            }
+
+
+status_cache = StatusCache()
@@ -0,0 +1,396 @@
+import os
+import time
+import queue
+import atexit
+import sqlite3
+import weakref
+import threading
+from contextlib import contextmanager
+
+# ============================================================
+# 🗄️ SQLite connection layer
+# ------------------------------------------------------------
+# The single place that opens connections to estack.db (eStack
+# investments/loans, synced to Dropbox) and transactions.db (StudyCraft
+# payments, loans, wallets, notifications).
+#
+# Every connection gets WAL journaling (readers and the callback writer
+# no longer block each other), synchronous=NORMAL, a busy timeout, a
+# larger page/statement cache and mmap I/O. Request handlers get one
+# connection per thread per database, reused across requests; the
+# Flask teardown calls release() so no transaction outlives its request.
+#
+# Lifetime of a thread's connection: it is opened on first use, kept
+# (idle, outside any transaction) between requests served by the same
+# thread, and closed when
+#   - a request on that thread fails (release(exception)),
+#   - the file is replaced (invalidate(), checked on the next use),
+#   - the thread exits (its thread-local holder is collected), or
+#   - the process exits (close_all).
+# Worker threads of gthread/sync gunicorn live for the whole process;
+# with GUNICORN_WORKER_CLASS=gevent threading.local is per greenlet and
+# the threaded dev server starts a thread per request, so there the
+# connection lasts exactly one request.
+#
+# Background components that keep one connection across iterations
+# (group-commit writers, deposit watcher, investment pool mirror,
+# callback registry) hold a SharedConnection: it is used under a lock,
+# reopened after invalidate(), and invalidate() closes it straight away,
+# so nothing outside this module keeps a replaced file - or its WAL -
+# open.
+#
+# GET endpoints borrow from a separate ReadPool per database instead:
+# mode=ro + query_only connections that never take the write lock, so
+# polling clients cannot queue behind (or block) the callback writer.
+#
+# SQLITE_READ_POOL_SIZE        - read connections per database per process
+# SQLITE_READ_POOL_TIMEOUT_MS  - how long a request waits for a free one
+# ============================================================
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ESTACK_DB = os.path.join(BASE_DIR, "estack.db")
+TRANSACTIONS_DB = os.path.join(BASE_DIR, "transactions.db")
+
+BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384"))
+MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+STATEMENT_CACHE = 256
+READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "8"))
+READ_POOL_TIMEOUT = float(os.getenv("SQLITE_READ_POOL_TIMEOUT_MS", "5000")) / 1000
+
+_local = threading.local()
+_registry_lock = threading.Lock()
+_all_connections = set()
+_generations = {}   # path -> int, bumped when the file is replaced underneath us
+_shared = weakref.WeakSet()     # every SharedConnection, closed by invalidate()
+
+
+def connect(path, readonly=False, **kwargs):
+    """
+    Open a new, fully configured connection. The caller owns (and closes) it.
+    readonly=True opens the file with mode=ro and query_only; the journal mode
+    is left to the writers (WAL is persistent once set).
+    """
+    kwargs.setdefault("timeout", BUSY_TIMEOUT_MS / 1000)
+    kwargs.setdefault("cached_statements", STATEMENT_CACHE)
+    if readonly:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, **kwargs)
+        conn.execute("PRAGMA query_only=ON")
+    else:
+        conn = sqlite3.connect(path, **kwargs)
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class _ThreadConnections(dict):
+    """path -> (conn, generation) for one thread; closes them when the thread goes away."""
+
+    def __del__(self):
+        for conn, _ in list(self.values()):
+            _close(conn)
+
+
+def thread_connection(path):
+    """This thread's read-write connection to path, reopened after invalidate()."""
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = _ThreadConnections()
+    generation = _generations.get(path, 0)
+    entry = conns.get(path)
+    if entry is not None and entry[1] != generation:
+        _close(entry[0])
+        entry = None
+    if entry is None:
+        # Closed from another thread only by thread-exit cleanup and close_all
+        conn = connect(path, check_same_thread=False)
+        with _registry_lock:
+            _all_connections.add(conn)
+        entry = conns[path] = (conn, generation)
+    return entry[0]
+
+
+def estack_db():
+    """This thread's connection to estack.db."""
+    return thread_connection(ESTACK_DB)
+
+
+def transactions_db():
+    """This thread's connection to transactions.db."""
+    return thread_connection(TRANSACTIONS_DB)
+
+
+class SharedConnection:
+    """
+    One long-lived connection to path for a background component, used via
+    use() under a lock. Reopened on first use after invalidate(), which also
+    closes it as soon as the current use (if any) finishes.
+    """
+
+    def __init__(self, path, readonly=False, **kwargs):
+        self.path = path
+        self.readonly = readonly
+        self.kwargs = kwargs        # passed on to connect()
+        self.opens = 0              # bumped per (re)open; per-connection state such as data_version resets
+        self._lock = threading.Lock()
+        self._conn = None
+        self._generation = None
+        with _registry_lock:
+            _shared.add(self)
+
+    @contextmanager
+    def use(self):
+        with self._lock:
+            generation = _generations.get(self.path, 0)
+            if self._conn is not None and self._generation != generation:
+                self._close()
+            if self._conn is None:
+                self._conn = connect(self.path, readonly=self.readonly, check_same_thread=False, **self.kwargs)
+                self._generation = generation
+                self.opens += 1
+            try:
+                yield self._conn
+            except sqlite3.Error:
+                self._close()
+                raise
+            finally:
+                if self._conn is not None and self._conn.in_transaction:
+                    self._conn.rollback()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except sqlite3.Error:
+                pass
+            self._conn = None
+
+
+class ReadPool:
+    """Bounded pool of read-only connections to one database, with wait-time stats."""
+
+    def __init__(self, path, size=READ_POOL_SIZE, timeout=READ_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened_at = {}    # id(conn) -> generation of the file when conn was opened
+        self.opened = 0
+        self.in_use = 0
+        self.acquired = 0
+        self.waited = 0
+        self.timeouts = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def acquire(self):
+        """Borrow a connection, opening one if the pool is below size, else waiting for one."""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self.opened < self.size
+                if can_open:
+                    self.opened += 1
+            conn = self._open() if can_open else self._wait()
+
+        if self._stale(conn):
+            # The file was replaced (restore) after this connection was opened
+            self._forget(conn)
+            conn = self._open()
+        with self._lock:
+            self.in_use += 1
+            self.acquired += 1
+        return conn
+
+    def _open(self):
+        """Open a connection for a slot already counted in self.opened."""
+        generation = _generations.get(self.path, 0)
+        try:
+            conn = connect(self.path, readonly=True, check_same_thread=False)
+        except Exception:
+            with self._lock:
+                self.opened -= 1
+            raise
+        with self._lock:
+            self._opened_at[id(conn)] = generation
+        return conn
+
+    def _stale(self, conn):
+        with self._lock:
+            return self._opened_at.get(id(conn)) != _generations.get(self.path, 0)
+
+    def _forget(self, conn):
+        """Close conn; its slot stays counted in self.opened for the caller to reuse or release."""
+        with self._lock:
+            self._opened_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _wait(self):
+        started = time.perf_counter()
+        try:
+            item = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self.timeouts += 1
+            raise sqlite3.OperationalError(
+                f"read pool for {os.path.basename(self.path)} exhausted ({self.size} connections)"
+            )
+        waited_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.waited += 1
+            self.total_wait_ms += waited_ms
+            self.max_wait_ms = max(self.max_wait_ms, waited_ms)
+        return item
+
+    def release(self, conn, broken=False):
+        with self._lock:
+            self.in_use -= 1
+        if not broken:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                broken = True
+        if broken or self._stale(conn):
+            # Failed, or opened on a file that has since been replaced: never re-pool it
+            self._forget(conn)
+            with self._lock:
+                self.opened -= 1
+            return
+        self._idle.put(conn)
+
+    def close_idle(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._forget(conn)
+            with self._lock:
+                self.opened -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self.opened,
+                "in_use": self.in_use,
+                "idle": self._idle.qsize(),
+                "acquired": self.acquired,
+                "waited": self.waited,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": round(self.total_wait_ms / self.waited, 2) if self.waited else 0.0,
+                "max_wait_ms": round(self.max_wait_ms, 2),
+            }
+
+
+read_pools = {
+    ESTACK_DB: ReadPool(ESTACK_DB),
+    TRANSACTIONS_DB: ReadPool(TRANSACTIONS_DB),
+}
+
+
+def _borrow(path):
+    borrowed = getattr(_local, "borrowed", None)
+    if borrowed is None:
+        borrowed = _local.borrowed = {}
+    conn = borrowed.get(path)
+    if conn is None:
+        conn = borrowed[path] = read_pools[path].acquire()
+    return conn
+
+
+def estack_reader():
+    """A read-only estack.db connection borrowed for the rest of this request."""
+    return _borrow(ESTACK_DB)
+
+
+def transactions_reader():
+    """A read-only transactions.db connection borrowed for the rest of this request."""
+    return _borrow(TRANSACTIONS_DB)
+
+
+def read_pool_stats():
+    return {os.path.basename(path): pool.stats() for path, pool in read_pools.items()}
+
+
+def release(exception=None):
+    """
+    End-of-request cleanup for this thread's connections: return borrowed
+    read connections to their pools, roll back anything left uncommitted,
+    and drop the connection entirely if the request failed.
+    """
+    borrowed = getattr(_local, "borrowed", None) or {}
+    for path, conn in list(borrowed.items()):
+        read_pools[path].release(conn, broken=exception is not None)
+    borrowed.clear()
+
+    conns = getattr(_local, "conns", None) or {}
+    for path, (conn, _) in list(conns.items()):
+        broken = exception is not None
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            broken = True
+        if broken:
+            _close(conn)
+            del conns[path]
+
+
+def invalidate(path):
+    """Force every thread to reopen `path` (e.g. after a restore replaced the file)."""
+    with _registry_lock:
+        _generations[path] = _generations.get(path, 0) + 1
+        shared = [c for c in _shared if c.path == path]
+    for conn in shared:
+        conn.close()
+    if path in read_pools:
+        read_pools[path].close_idle()
+
+
+def generation(path):
+    """Bumped by invalidate(); long-lived connections reopen when it changes."""
+    return _generations.get(path, 0)
+
+
+def _close(conn):
+    with _registry_lock:
+        _all_connections.discard(conn)
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
+@atexit.register
+def close_all():
+    """Close every thread and pooled connection still open (process shutdown)."""
+    for pool in read_pools.values():
+        pool.close_idle()
+    with _registry_lock:
+        shared = list(_shared)
+    for conn in shared:
+        conn.close()
+    with _registry_lock:
+        conns = list(_all_connections)
+        _all_connections.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
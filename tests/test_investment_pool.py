@@ -0,0 +1,75 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from investment_pool import InvestmentPool, FIFO, BEST_FIT  # noqa: E402
+from migrations import ESTACK_POOL_PREDICATE, create_pool_index  # noqa: E402
+
+
+@pytest.fixture
+def pool(tmp_path):
+    path = str(tmp_path / "estack.db")
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE estack_transactions (id INTEGER PRIMARY KEY, deposit_id TEXT, kind TEXT, status TEXT, amount REAL)"
+    )
+    create_pool_index(conn, "estack_transactions", "deposit_id", ESTACK_POOL_PREDICATE)
+    conn.executemany(
+        "INSERT INTO estack_transactions (deposit_id, kind, status, amount) VALUES (?, ?, ?, ?)",
+        [
+            ("old-small", "investment", "COMPLETED", 50),
+            ("old-large", "investment", "COMPLETED", 500),
+            ("new-fit", "investment", "AVAILABLE", 120),
+            ("in-use", "investment", "IN_USE", 100),
+            ("deposit", "deposit", "COMPLETED", 100),
+        ],
+    )
+    conn.commit()
+    yield InvestmentPool(path, "estack_transactions", "deposit_id", ESTACK_POOL_PREDICATE), conn
+    conn.close()
+
+
+def _status(conn, deposit_id):
+    return conn.execute("SELECT status FROM estack_transactions WHERE deposit_id = ?", (deposit_id,)).fetchone()[0]
+
+
+def test_fifo_claims_oldest_covering_investment(pool):
+    pool, conn = pool
+    claimed = pool.claim(conn, "IN_USE", amount=100, strategy=FIFO)
+    conn.commit()
+    assert claimed["investment_id"] == "old-large"
+    assert _status(conn, "old-large") == "IN_USE"
+
+
+def test_best_fit_claims_smallest_covering_investment(pool):
+    pool, conn = pool
+    claimed = pool.claim(conn, "IN_USE", amount=100, strategy=BEST_FIT)
+    conn.commit()
+    assert claimed["investment_id"] == "new-fit"
+    assert _status(conn, "new-fit") == "IN_USE"
+
+
+def test_claimed_investment_is_not_claimed_twice(pool):
+    pool, conn = pool
+    first = pool.claim(conn, "IN_USE", amount=100, strategy=BEST_FIT)
+    conn.commit()
+    second = pool.claim(conn, "IN_USE", amount=100, strategy=BEST_FIT)
+    conn.commit()
+    assert first["investment_id"] == "new-fit"
+    assert second["investment_id"] == "old-large"
+    assert pool.claim(conn, "IN_USE", amount=100, strategy=FIFO) is None
+
+
+def test_named_claim_respects_from_status(pool):
+    pool, conn = pool
+    assert pool.claim(conn, "IN_USE", investment_id="new-fit", from_status="COMPLETED") is None
+    assert pool.claim(conn, "IN_USE", investment_id="in-use", from_status="COMPLETED") is None
+    claimed = pool.claim(conn, "IN_USE", investment_id="old-small", from_status="COMPLETED")
+    conn.commit()
+    assert claimed == {"id": 1, "investment_id": "old-small", "amount": 50}
+    assert _status(conn, "new-fit") == "AVAILABLE"
@@ -0,0 +1,72 @@
+import logging
+from datetime import datetime
+
+# ============================================================
+# 📒 Wallet ledger
+# ------------------------------------------------------------
+# Every balance change is an immutable row in wallet_ledger (UPDATE and
+# DELETE are rejected by triggers, see migrations.py). wallets.balance
+# is a materialized sum of those rows: post() inserts the entry and
+# applies "balance = COALESCE(balance, 0) + ?" (older wallets may hold
+# NULL) in the caller's transaction, so concurrent postings to the same
+# wallet cannot lose an update and the caller commits the entry, the
+# balance and its own changes (loan status, transactions row) together.
+#
+# verify() recomputes every balance from the ledger in one aggregate
+# query; rebuild() writes the recomputed balances back.
+# ============================================================
+
+logger = logging.getLogger(__name__)
+
+TOLERANCE = 1e-6    # balances are REAL; ignore float noise when comparing
+
+
+def post(conn, user_id, amount, kind, reference=None):
+    """Append a ledger entry and apply it to the wallet (created if missing). Returns the new balance."""
+    now = datetime.utcnow().isoformat()
+    conn.execute("""
+        INSERT INTO wallets (user_id, balance, created_at, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            balance = COALESCE(balance, 0) + excluded.balance,    -- older rows may have a NULL balance
+            updated_at = excluded.updated_at
+    """, (user_id, amount, now, now))
+    balance = conn.execute("SELECT balance FROM wallets WHERE user_id = ?", (user_id,)).fetchone()[0]
+    conn.execute("""
+        INSERT INTO wallet_ledger (user_id, amount, kind, reference, balance_after, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (user_id, amount, kind, reference, balance, now))
+    return balance
+
+
+_DRIFT_SQL = """
+    SELECT w.user_id, w.balance, COALESCE(l.total, 0), COALESCE(l.entries, 0)
+    FROM wallets w
+    LEFT JOIN (
+        SELECT user_id, SUM(amount) AS total, COUNT(*) AS entries FROM wallet_ledger GROUP BY user_id
+    ) l ON l.user_id = w.user_id
+"""
+
+
+def verify(conn):
+    """Compare every wallet balance with the sum of its ledger entries."""
+    wallets = entries = 0
+    mismatches = []
+    for user_id, balance, total, count in conn.execute(_DRIFT_SQL):
+        wallets += 1
+        entries += count
+        if abs((balance or 0) - total) > TOLERANCE:
+            mismatches.append({"user_id": user_id, "balance": balance, "ledger_balance": total})
+    return {"wallets": wallets, "entries": entries, "mismatches": mismatches}
+
+
+def rebuild(conn):
+    """Reset every drifted balance to its ledger sum. Returns the verify() report from before the fix."""
+    report = verify(conn)
+    now = datetime.utcnow().isoformat()
+    conn.executemany(
+        "UPDATE wallets SET balance = ?, updated_at = ? WHERE user_id = ?",
+        [(m["ledger_balance"], now, m["user_id"]) for m in report["mismatches"]],
+    )
+    if report["mismatches"]:
+        logger.warning("Rebuilt %d wallet balances from the ledger", len(report["mismatches"]))
+    return report